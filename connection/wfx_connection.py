@@ -5,91 +5,655 @@
 #     - Marc Dorval <marc.dorval@silabs.com>
 #
 import os
+import re
 import sys
+import glob
 import time
+import shlex
+import random
+import select
+import subprocess
+import collections
 import socket
 import logging
+import threading
+
+from wfx_latency import *
+from wfx_trace import *
+from wfx_frames import *
 
 logging.basicConfig(level=logging.INFO)
 
-try:
-    import serial
-except ImportError:
-    loaded_serial = False
-    print("'serial'     is not installed. UART connection impossible")
-else:
-    loaded_serial = True
-    logging.getLogger("serial").setLevel(logging.WARNING)
-print('loaded_serial     ' + str(loaded_serial))
-
-try:
-    import paramiko
-except ImportError:
-    loaded_paramiko = False
-    print("'paramiko'   is not installed. SSH connection impossible")
-else:
-    loaded_paramiko = True
-    logging.getLogger("paramiko").setLevel(logging.WARNING)
-print('loaded_paramiko   ' + str(loaded_paramiko))
-
-try:
-    import telnetlib
-except ImportError:
-    loaded_telnetlib = False
-    print("'telnetlib'  is not installed. TELNET connection impossible")
-else:
-    loaded_telnetlib = True
-    logging.getLogger("telnetlib").setLevel(logging.WARNING)
-print('loaded_telnetlib  ' + str(loaded_telnetlib))
-
-
-class SshTarget(paramiko.client.SSHClient):
-
-    def __init__(self, host, name=None, wait=False, user="root", port=22, password=""):
-        super().__init__()
+# Link backends are only imported when a link of that type is created: importing this module stays fast
+#  (paramiko alone takes hundreds of ms) and works without any of them
+serial = None
+paramiko = None
+telnetlib = None
+
+
+def load_serial():
+    global serial
+    if serial is None:
+        try:
+            import serial
+        except ImportError:
+            return None
+        logging.getLogger("serial").setLevel(logging.WARNING)
+    return serial
+
+
+def load_paramiko():
+    global paramiko
+    if paramiko is None:
+        try:
+            import paramiko
+        except ImportError:
+            return None
+        logging.getLogger("paramiko").setLevel(logging.WARNING)
+    return paramiko
+
+
+def load_telnetlib():
+    global telnetlib
+    if telnetlib is None:
+        try:
+            import telnetlib
+        except ImportError:
+            return None
+        logging.getLogger("telnetlib").setLevel(logging.WARNING)
+    return telnetlib
+
+
+class LinkTimeout(Exception):
+    """
+        Raised by wait_for()/run_until() when the expected output didn't arrive in time
+    """
+
+    def __init__(self, nickname, pattern, timeout, received):
+        self.nickname = nickname
+        self.pattern = pattern
+        self.timeout = timeout
+        self.received = received
+        pattern = getattr(pattern, 'pattern', pattern)
+        super().__init__("%s: no output matching %s after %.1f s. Received:\n%s" % (nickname, pattern, timeout,
+                                                                                     received))
+
+
+class FramedResponse(object):
+    """
+        Accumulates the stdout/stderr data of one framed shell command until both end markers are seen
+    """
+
+    def __init__(self, marker):
+        self.out_end = bytes('\n' + marker + ' ', 'utf-8')
+        self.err_end = bytes('\n' + marker + '\n', 'utf-8')
+        self.out = b''
+        self.err = b''
+        self.status = None
+        self.out_done = False
+        self.err_done = False
+
+    @property
+    def done(self):
+        return self.out_done and self.err_done
+
+    def feed(self, stream, data):
+        # Returns the data following this command's end marker, which belongs to the next command
+        if stream == 1 and not self.out_done:
+            self.out += data
+            index = self.out.find(self.out_end)
+            if index >= 0 and b'\n' in self.out[index + len(self.out_end):]:
+                end = self.out.index(b'\n', index + len(self.out_end))
+                self.status = int(self.out[index + len(self.out_end):end])
+                self.out, rest = self.out[:index], self.out[end + 1:]
+                self.out_done = True
+                return rest
+            return b''
+        if stream == 2 and not self.err_done:
+            self.err += data
+            index = self.err.find(self.err_end)
+            if index >= 0:
+                self.err, rest = self.err[:index], self.err[index + len(self.err_end):]
+                self.err_done = True
+                return rest
+            return b''
+        return data
+
+
+class FramedShell(object):
+    """
+        Runs commands in a single long-lived shell.
+        Each command is followed by a unique end marker (carrying the exit status) on stdout
+         and by the same marker on stderr, so that both streams can be split per command.
+        Subclasses provide the transport (_open, _close, _alive, _send, _recv)
+    """
+
+    def __init__(self, timeout=None):
+        self.token = '%08x' % random.getrandbits(32)
+        self.sequence = 0
+        self.pending = []
+        self.rest = {1: b'', 2: b''}
+        self.response = None
+        self.streamed = 0
+        self.first_byte = None
+        self.timeout = timeout
+        self.exit_status = None
+        # True once a command ended the shell ('exit', 'reboot'...), until the next command
+        self.ended = False
+
+    def _open(self):
+        raise NotImplementedError()
+
+    def _close(self):
+        raise NotImplementedError()
+
+    def _alive(self):
+        raise NotImplementedError()
+
+    def _send(self, data):
+        raise NotImplementedError()
+
+    def _recv(self, timeout):
+        # Returns a list of (stream, bytes) tuples (stream 1 is stdout, stream 2 is stderr),
+        #  an empty list on timeout, raises EOFError once the shell is gone
+        raise NotImplementedError()
+
+    def _marker(self):
+        self.sequence += 1
+        return '__wfx_%s_%d__' % (self.token, self.sequence)
+
+    def frame(self, cmd, marker):
+        # stdin is redirected so that commands reading it can't swallow the markers
+        return '{ %s\n} < /dev/null\n' % cmd.strip() + \
+               'wfx_status=$?\n' + \
+               'printf \'\\n%%s\\n\' \'%s\' >&2\n' % marker + \
+               'printf \'\\n%%s %%d\\n\' \'%s\' $wfx_status\n' % marker
+
+    def script(self, commands):
+        # Returns a single script running all commands, and the end marker of each command
+        markers = []
+        script = ''
+        for cmd in commands:
+            if isinstance(cmd, bytes):
+                cmd = str(cmd, 'utf-8')
+            markers.append(self._marker())
+            script += self.frame(cmd, markers[-1])
+        return bytes(script, 'utf-8'), markers
+
+    @staticmethod
+    def split(out, err, markers):
+        # Splits the complete stdout/stderr of a script() into one (out, err, status) tuple per command
+        results = []
+        for marker in markers:
+            response = FramedResponse(marker)
+            out = response.feed(1, out)
+            err = response.feed(2, err)
+            results.append((response.out, response.err, response.status))
+        return results
+
+    def open(self):
+        # Starts the shell if it's not running
+        if not self._alive():
+            self.close()
+            self._open()
+
+    def send_many(self, commands):
+        data, markers = self.script(commands)
+        self.ended = False
+        self.open()
+        try:
+            self._send(data)
+        except (OSError, EOFError):
+            # The shell died since the last command: start a new one and retry once
+            self.close()
+            self._open()
+            self._send(data)
+        self.pending.extend(markers)
+
+    def send(self, cmd):
+        self.send_many([cmd])
+
+    def _response(self):
+        # Starts the response of the oldest pending command, with the data already received for it
+        response = FramedResponse(self.pending.pop(0))
+        self.first_byte = None
+        for stream in [1, 2]:
+            data, self.rest[stream] = self.rest[stream], b''
+            self.rest[stream] += response.feed(stream, data)
+        return response
+
+    def _feed(self, response, stream, data):
+        if self.first_byte is None:
+            self.first_byte = time.time()
+        self.rest[stream] += response.feed(stream, data)
+
+    def _current(self):
+        # Response of the oldest pending command, None if there is none
+        if self.response is None and self.pending:
+            self.response = self._response()
+            self.streamed = 0
+        return self.response
+
+    def stream(self, timeout):
+        # stdout of the oldest pending command received so far (waiting up to timeout for more), without waiting
+        #  for the command to end. The returned data is consumed: collect() only returns what follows
+        response = self._current()
+        if response is None:
+            return b''
+        try:
+            if not response.done:
+                for stream, data in self._recv(timeout):
+                    self._feed(response, stream, data)
+        except EOFError:
+            self.close()
+            self.ended = True
+        # The end marker line starts with a newline: output is held back from the last newline until then
+        end = len(response.out) if response.out_done else response.out.rfind(b'\n') + 1
+        data = response.out[self.streamed:max(end, self.streamed)]
+        self.streamed += len(data)
+        if response.done and self.streamed == len(response.out):
+            self.exit_status = response.status
+            self.response = None
+        return data
+
+    def collect(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        response = self._current()
+        if response is None:
+            return b'', b'', None
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while not response.done:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    logging.warning("shell command timed out after %.3f s, restarting the shell" % timeout)
+                    self.close()
+                    break
+                for stream, data in self._recv(remaining):
+                    self._feed(response, stream, data)
+        except EOFError:
+            # The command ended the shell ('exit', 'reboot'...): a new one is started by the next send()
+            self.close()
+            self.ended = True
+        self.response = None
+        self.exit_status = response.status
+        return response.out[self.streamed:], response.err, response.status
+
+    def execute(self, cmd, timeout=None):
+        self.send(cmd)
+        return self.collect(timeout)
+
+    def execute_many(self, commands, timeout=None):
+        self.send_many(commands)
+        return [self.collect(timeout) for cmd in commands]
+
+    def close(self):
+        self.pending = []
+        self.rest = {1: b'', 2: b''}
+        self.response = None
+        self._close()
+
+
+class SshShell(FramedShell):
+
+    def __init__(self, client, timeout=None):
+        super().__init__(timeout)
+        self.client = client
+        self.channel = None
+
+    def _open(self):
+        self.channel = self.client.get_transport().open_session()
+        self.channel.exec_command('/bin/sh')
+        self._send(b'. /etc/profile > /dev/null 2>&1\n')
+
+    def _close(self):
+        if self.channel is not None:
+            self.channel.close()
+        self.channel = None
+
+    def _alive(self):
+        return self.channel is not None and not self.channel.closed and not self.channel.exit_status_ready()
+
+    def _send(self, data):
+        if self.channel is None:
+            raise EOFError()
+        self.channel.sendall(data)
+
+    def _recv(self, timeout):
+        channel = self.channel
+        if channel is None:
+            raise EOFError()
+        if not (channel.recv_ready() or channel.recv_stderr_ready()):
+            if channel.closed or channel.exit_status_ready():
+                raise EOFError()
+            select.select([channel], [], [], timeout)
+        chunks = []
+        if channel.recv_ready():
+            chunks.append((1, channel.recv(65536)))
+        if channel.recv_stderr_ready():
+            chunks.append((2, channel.recv_stderr(65536)))
+        if not chunks and (channel.closed or channel.exit_status_ready()):
+            raise EOFError()
+        return chunks
+
+
+class LocalShell(FramedShell):
+
+    def __init__(self, timeout=None):
+        super().__init__(timeout)
+        self.process = None
+
+    def _open(self):
+        self.process = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+
+    def _close(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            for pipe in [self.process.stdin, self.process.stdout, self.process.stderr]:
+                pipe.close()
+        self.process = None
+
+    def _alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _send(self, data):
+        if self.process is None:
+            raise EOFError()
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def _recv(self, timeout):
+        if self.process is None:
+            raise EOFError()
+        streams = {self.process.stdout.fileno(): 1, self.process.stderr.fileno(): 2}
+        readable, _, _ = select.select(list(streams), [], [], timeout)
+        chunks = []
+        for fileno in readable:
+            data = os.read(fileno, 65536)
+            if not data:
+                raise EOFError()
+            chunks.append((streams[fileno], data))
+        return chunks
+
+
+class TelnetShell(FramedShell):
+    """
+        Framed shell over a telnet session. The terminal merges stderr with stdout: each command's stderr is
+         redirected to stdout, and echo is disabled so that the commands don't appear in their output
+    """
+
+    def __init__(self, host, user, password=None, port=23, timeout=None, login_timeout=10.0):
+        super().__init__(timeout)
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.login_timeout = login_timeout
+        self.session = None
+
+    def frame(self, cmd, marker):
+        return '{ %s\n} < /dev/null 2>&1\n' % cmd.strip() + \
+               'wfx_status=$?\n' + \
+               'printf \'\\n%%s %%d\\n\' \'%s\' $wfx_status\n' % marker
+
+    def _response(self):
+        response = super()._response()
+        response.err_done = True
+        return response
+
+    def _open(self):
+        timeout = self.login_timeout
+        self.session = telnetlib.Telnet(self.host, self.port, timeout)
+        # Commands are small writes waiting for an answer: no Nagle delay
+        self.session.get_socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.session.read_until(b'login: ', timeout)
+        self.session.write(bytes(self.user + '\n', 'utf-8'))
+        if self.password:
+            self.session.read_until(b'assword: ', timeout)
+            self.session.write(bytes(self.password + '\n', 'utf-8'))
+        # Input sent before the shell prompt may be flushed by login
+        self.session.expect([re.compile(rb'[$#>%] ?$')], timeout)
+        # No echo, no prompts, no CR/LF translation. The ready marker is split so that its echo doesn't match
+        ready = '__wfx_%s_ready__' % self.token
+        self.session.write(bytes('stty -echo -onlcr; PS1=""; PS2=""; printf \'%%s%%s\\n\' \'%s\' \'%s\'\n' %
+                                 (ready[:6], ready[6:]), 'utf-8'))
+        index, match, data = self.session.expect([re.compile(bytes('^' + ready + '\r?$', 'utf-8'), re.M)], timeout)
+        if index < 0:
+            self._close()
+            raise Exception("Telnet %s@%s:%s: no shell after %.1f s. Received: %s" % (self.user, self.host, self.port,
+                                                                                      timeout, data))
+        self.session.read_very_eager()
+
+    def _close(self):
+        if self.session is not None:
+            self.session.close()
+        self.session = None
+
+    def _alive(self):
+        return self.session is not None and not self.session.eof
+
+    def _send(self, data):
+        if self.session is None:
+            raise EOFError()
+        self.session.write(data)
+
+    def _recv(self, timeout):
+        if self.session is None:
+            raise EOFError()
+        data = self.session.read_very_eager()
+        if not data:
+            select.select([self.session], [], [], timeout)
+            data = self.session.read_very_eager()
+        if not data and self.session.eof:
+            # Closed by the server (the command ended the shell)
+            raise EOFError()
+        return [(1, data)] if data else []
+
+
+class SshPool(object):
+    """
+        Process-wide pool of authenticated SSH clients, keyed by (host, port, user)
+        All links to the same key open their own channels over a single transport.
+        Transports are reference-counted and closed once unused for idle_s seconds
+    """
+
+    def __init__(self, idle_s=30.0):
+        self.idle_s = idle_s
+        self.lock = threading.RLock()
+        self.entries = dict()
+        # Keys being connected, set once done
+        self.connecting = dict()
+        self.hits = 0
+        self.misses = 0
+        self.closed = 0
+        self.timer = None
+
+    @staticmethod
+    def _active(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def acquire(self, key, connect):
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    if self._active(entry['client']):
+                        entry['refs'] += 1
+                        entry['idle_since'] = None
+                        self.hits += 1
+                        return entry['client']
+                    self._close(key)
+                connecting = self.connecting.get(key)
+                if connecting is None:
+                    connecting = threading.Event()
+                    self.connecting[key] = connecting
+                    self.misses += 1
+                    break
+            # Another thread is connecting to key: share its client (or connect if it failed)
+            connecting.wait()
+        # Connecting can take seconds: don't block the other keys meanwhile
+        client = None
+        try:
+            client = connect()
+        finally:
+            with self.lock:
+                del self.connecting[key]
+                if client is not None:
+                    self.entries[key] = {'client': client, 'refs': 1, 'idle_since': None}
+                connecting.set()
+        return client
+
+    def release(self, key, client):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['client'] is not client:
+                # Already replaced after its transport died
+                client.close()
+                return
+            entry['refs'] = max(0, entry['refs'] - 1)
+            if entry['refs'] == 0:
+                entry['idle_since'] = time.time()
+                self._schedule()
+
+    def _schedule(self):
+        if self.timer is None or not self.timer.is_alive():
+            self.timer = threading.Timer(self.idle_s, self.close_idle)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _close(self, key):
+        entry = self.entries.pop(key)
+        entry['client'].close()
+        self.closed += 1
+
+    def close_idle(self, idle_s=None):
+        idle_s = self.idle_s if idle_s is None else idle_s
+        now = time.time()
+        with self.lock:
+            for key in list(self.entries.keys()):
+                idle_since = self.entries[key]['idle_since']
+                if idle_since is not None and now - idle_since >= idle_s:
+                    self._close(key)
+            if any(entry['idle_since'] is not None for entry in self.entries.values()):
+                self.timer = None
+                self._schedule()
+
+    def close_all(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self._close(key)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'open': len(self.entries),
+                    'in_use': sum(1 for entry in self.entries.values() if entry['refs'] > 0),
+                    'closed': self.closed}
+
+
+ssh_pool = SshPool()
+
+
+class SshTarget(object):
+
+    def __init__(self, host, name=None, wait=False, user="root", port=22, password="", persistent=False,
+                 pooled=True, keepalive_s=5, reconnect_s=60.0, send_key=True):
         self.user = user
         self.host = host
         self.port = port
         self.password = password
         self.name = name if name else host
+        self.client = None
         self.stdin = None
         self.stdout = None
         self.stderr = None
         self.result = None
         self.error = None
         self.local_trace = False
+        self.persistent = persistent
+        self.pooled = pooled
+        self.shell = None
+        self.exit_status = None
+        self.first_byte = None
+        # keepalive_s: transport keepalive period, so that a rebooted DUT resets the transport instead of hanging it
+        # reconnect_s: time spent reconnecting (with exponential backoff) when the transport is lost
+        self.keepalive_s = keepalive_s
+        self.reconnect_s = reconnect_s
+        self.send_key = send_key
+        self.key_sent = False
+        # (duration_s, error) of each attempt of the last connection, and number of reconnections
+        self.attempts = []
+        self.connect_s = None
+        self.reconnects = 0
+        # Command being executed, sent again after a reconnection
+        self.command = None
+        # SFTP session for read_file()/write_file(), opened on first use
+        self.sftp = None
         if len(self.name) > 10:
             self.name = "…" + self.name[-9:]
-        self.__connect(wait)
-
-    def __connect(self, wait=False):
+        if load_paramiko() is None:
+            raise Exception("'paramiko'   is not installed. SSH connection impossible for " + self.name)
+        self.client = self.__acquire(wait, 10.0)
+
+    def __acquire(self, wait, budget_s):
+        if self.pooled:
+            return ssh_pool.acquire((self.host, self.port, self.user), lambda: self.__connect(wait, budget_s))
+        return self.__connect(wait, budget_s)
+
+    def __connect(self, wait=False, budget_s=10.0):
+        # Tries to connect for up to budget_s seconds (a single attempt when not waiting for the DUT to boot),
+        #  with an exponential backoff from 0.1 to 2 seconds between attempts
         cmd_name = "%-6s" % self.name
         err = None
-        self.set_missing_host_key_policy(paramiko.client.AutoAddPolicy)
-        start = now = time.time()
-        while start + 10 > now:
+        delay = 0.1
+        self.attempts = []
+        start = time.time()
+        while True:
+            client = paramiko.client.SSHClient()
+            client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy)
+            attempt = time.time()
             try:
-                self.connect(self.host, username=self.user, port=self.port, timeout=1, banner_timeout=1,
-                             auth_timeout=1, password=self.password)
-                peer = self.get_transport().getpeername()
-                logging.info("%-13s I'm connected to %s:%d as %s" % (cmd_name, peer[0], peer[1], self.user))
-                return
-            except socket.timeout:
-                if not wait:
-                    break
-                if err != socket.timeout:
-                    logging.info("%-13s I %s" % (cmd_name, "didn't boot yet. Wait."))
-                    err = socket.timeout
-            except paramiko.ssh_exception.NoValidConnectionsError:
-                if not wait:
-                    break
+                client.connect(self.host, username=self.user, port=self.port, timeout=1, banner_timeout=1,
+                               auth_timeout=1, password=self.password)
+                transport = client.get_transport()
+                transport.set_keepalive(self.keepalive_s)
+                self.attempts.append((round(time.time() - attempt, 3), None))
+                self.connect_s = round(time.time() - start, 3)
+                peer = transport.getpeername()
+                logging.info("%-13s I'm connected to %s:%d as %s (%d attempt(s), %.3f s)" %
+                             (cmd_name, peer[0], peer[1], self.user, len(self.attempts), self.connect_s))
+                return client
+            except paramiko.ssh_exception.NoValidConnectionsError as e:
+                client.close()
+                self.attempts.append((round(time.time() - attempt, 3), type(e).__name__))
                 if err != paramiko.ssh_exception.NoValidConnectionsError:
                     logging.info("%-13s %s" % (cmd_name, "boot nearly finished"))
                     err = paramiko.ssh_exception.NoValidConnectionsError
-            except paramiko.ssh_exception.SSHException:
+            except paramiko.ssh_exception.SSHException as e:
+                client.close()
+                self.attempts.append((round(time.time() - attempt, 3), type(e).__name__))
+                if not self.send_key or self.key_sent:
+                    break
+                # Once only: the next attempt uses the key (no recursion through __send_key())
+                self.key_sent = True
                 self.__send_key(self.password)
-                return self.__connect()
-            now = time.time()
+                continue
+            except (socket.timeout, OSError) as e:
+                client.close()
+                self.attempts.append((round(time.time() - attempt, 3), type(e).__name__))
+                if err != socket.timeout:
+                    logging.info("%-13s I %s" % (cmd_name, "didn't boot yet. Wait."))
+                    err = socket.timeout
+            if not wait or time.time() + delay > start + budget_s:
+                break
+            time.sleep(delay)
+            delay = min(2.0, delay * 2)
+        self.connect_s = round(time.time() - start, 3)
         logging.info("%-13s I can't connect to %s:%d as %s" % (cmd_name, self.host, self.port, self.user))
         raise Exception("%s: Cannot connect over SSH to %s:%d as %s" % (cmd_name, self.host, self.port, self.user))
 
@@ -98,33 +662,186 @@ class SshTarget(paramiko.client.SSHClient):
         # Therefore we try to log using the 'pi' account to add our public key and copy it to the root account
         a = paramiko.Agent()
         ks = a.get_keys()
+        if not ks:
+            return
         k = ks[0].get_base64()
         for pwd in {'default_password', original_pwd}:
             if pwd is not None:
                 print("Trying to add the tester public key to /root/.ssh/authorized_keys using \'" + pwd + "\'")
                 try:
-                    tmp_dut = SshTarget(self.host, name='tmp_dut', port=self.port, user='pi', password=pwd)
-                    print(type(tmp_dut))
-                    tmp_dut.write('sudo mkdir -p /root/.ssh')
-                    tmp_dut.write('echo ' + 'ssh-rsa ' + str(k) + '> ~/.ssh/authorized_keys2')
-                    tmp_dut.write('sudo tee -a /root/.ssh/authorized_keys < ~/.ssh/authorized_keys2')
-                except paramiko.ssh_exception.SSHException:
+                    tmp_dut = SshTarget(self.host, name='tmp_dut', port=self.port, user='pi', password=pwd,
+                                        pooled=False, send_key=False)
+                    for cmd in ['sudo mkdir -p /root/.ssh',
+                                'echo ' + 'ssh-rsa ' + str(k) + '> ~/.ssh/authorized_keys2',
+                                'sudo tee -a /root/.ssh/authorized_keys < ~/.ssh/authorized_keys2']:
+                        tmp_dut.write(cmd)
+                        tmp_dut.read()
+                    tmp_dut.close()
+                except Exception:
                     pass
 
+    def alive(self, probe_timeout=None):
+        # Cheap check of the transport state. With probe_timeout, also checks that the DUT answers (one round trip)
+        transport = self.client.get_transport() if self.client is not None else None
+        if transport is None or not transport.is_active():
+            return False
+        if probe_timeout is not None:
+            try:
+                transport.open_session(timeout=probe_timeout).close()
+            except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+                return False
+        return True
+
+    def reconnect(self):
+        # Replaces the lost transport (retrying for up to reconnect_s seconds). The pool drops the dead one
+        logging.warning("%-13s SSH link to %s:%d lost, reconnecting" % ("%-6s" % self.name, self.host, self.port))
+        if self.shell is not None:
+            self.shell.close()
+            self.shell = None
+        self.sftp = None
+        if self.client is not None:
+            if self.pooled:
+                ssh_pool.release((self.host, self.port, self.user), self.client)
+            else:
+                self.client.close()
+            self.client = None
+        self.client = self.__acquire(True, self.reconnect_s)
+        self.reconnects += 1
+
+    def __write(self, text):
+        if self.persistent:
+            if self.shell is None:
+                self.shell = SshShell(self.client)
+            self.shell.send(text)
+        else:
+            self.stdin, self.stdout, self.stderr = self.client.exec_command(text,
+                                                                            environment={'ENV': '/etc/profile'})
+
     def write(self, text):
         if self is not None:
-            self.stdin, self.stdout, self.stderr = self.exec_command(text, environment={'ENV': '/etc/profile'})
+            self.command = text
+            if not self.alive():
+                self.reconnect()
+            try:
+                self.__write(text)
+            except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+                self.reconnect()
+                self.__write(text)
+
+    def __read(self):
+        if self.persistent:
+            out, err, self.exit_status = self.shell.collect() if self.shell else (b'', b'', None)
+            self.first_byte = self.shell.first_byte if self.shell else None
+        else:
+            if not self.stdout.channel.recv_ready():
+                select.select([self.stdout.channel], [], [])
+            self.first_byte = time.time()
+            out = self.stdout.read()
+            err = self.stderr.read()
+            self.exit_status = self.stdout.channel.recv_exit_status()
+            # -1: the channel was closed without an exit status
+            if self.exit_status == -1:
+                self.exit_status = None
+        self.result = str(out, "utf-8").strip()
+        self.error = str(err, "utf-8").strip()
 
     def read(self):
-        self.result = str(self.stdout.read(), "utf-8").strip()
-        self.error = str(self.stderr.read(), "utf-8").strip()
+        self.__read()
+        if self.exit_status is None and self.command is not None and not self.alive():
+            # The transport was lost during the command (DUT reboot...): run it again over a new one
+            self.reconnect()
+            self.__write(self.command)
+            self.__read()
+        self.command = None
         if not self.result:
             return "ERROR: " + self.error
         else:
             return self.result
 
-
-class AbstractConnection(object):
+    def read_chunk(self, timeout):
+        # Output of the current command received so far (waiting up to timeout for some). It's not returned by read()
+        if self.persistent:
+            return self.shell.stream(timeout) if self.shell else b''
+        if self.stdout is None:
+            return b''
+        channel = self.stdout.channel
+        if not channel.recv_ready() and not channel.exit_status_ready():
+            select.select([channel], [], [], timeout)
+        return channel.recv(65536) if channel.recv_ready() else b''
+
+    def __run_many(self, commands):
+        if self.persistent:
+            if self.shell is None:
+                self.shell = SshShell(self.client)
+            return self.shell.execute_many(commands)
+        script, markers = FramedShell().script(commands)
+        self.stdin, self.stdout, self.stderr = self.client.exec_command(str(script, 'utf-8'),
+                                                                        environment={'ENV': '/etc/profile'})
+        return FramedShell.split(self.stdout.read(), self.stderr.read(), markers)
+
+    def run_many(self, commands):
+        # All commands in a single round trip, returns one (read() like result, exit_status) per command
+        if not self.alive():
+            self.reconnect()
+        try:
+            responses = self.__run_many(commands)
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+            self.reconnect()
+            responses = self.__run_many(commands)
+        # Commands not completed when the transport was lost are run again over a new one
+        unfinished = [n for n, response in enumerate(responses) if response[2] is None]
+        if unfinished and not self.alive():
+            self.reconnect()
+            for n, response in zip(unfinished, self.__run_many([commands[n] for n in unfinished])):
+                responses[n] = response
+        results = []
+        for out, err, self.exit_status in responses:
+            self.result = str(out, "utf-8").strip()
+            self.error = str(err, "utf-8").strip()
+            results.append((self.result if self.result else "ERROR: " + self.error, self.exit_status))
+        return results
+
+    def __sftp(self):
+        if self.sftp is None or self.sftp.get_channel().closed:
+            self.sftp = self.client.open_sftp()
+        return self.sftp
+
+    def __file(self, path, mode, data=None):
+        with self.__sftp().open(path, mode) as f:
+            return f.read() if data is None else f.write(data)
+
+    def file(self, path, mode, data=None):
+        # Reads (data is None) or writes a remote file over the SFTP session, reconnecting if the link was lost
+        self.first_byte = None
+        if not self.alive():
+            self.reconnect()
+        try:
+            res = self.__file(path, mode, data)
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+            # Errors on a live link (no such file...) are not link losses
+            if self.alive():
+                raise
+            self.reconnect()
+            res = self.__file(path, mode, data)
+        self.first_byte = time.time()
+        return res
+
+    def close(self):
+        if self.sftp is not None:
+            self.sftp.close()
+            self.sftp = None
+        if self.shell is not None:
+            self.shell.close()
+            self.shell = None
+        if self.client is not None:
+            if self.pooled:
+                ssh_pool.release((self.host, self.port, self.user), self.client)
+            else:
+                self.client.close()
+            self.client = None
+
+
+class AbstractConnection(LatencyHooks):
     link = None
     connection = None
     nickname = ''
@@ -142,29 +859,198 @@ class AbstractConnection(object):
     def run(self, cmd, wait_ms=0):
         raise NotImplementedError()
 
+    def _read_chunk(self, timeout):
+        # Output received since the last call (waiting up to timeout for some), '' if none
+        raise NotImplementedError()
+
+    def wait_for(self, pattern, timeout=10.0):
+        # Returns the output received (since the last read) as soon as it matches pattern (regex or predicate)
+        #  Raises LinkTimeout if it doesn't match within timeout
+        match = pattern if callable(pattern) else re.compile(pattern).search
+        received = ''
+        deadline = time.time() + timeout
+        while not match(received):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise LinkTimeout(self.nickname, pattern, timeout, received)
+            chunk = self._read_chunk(remaining)
+            if chunk and self.first_byte is None:
+                self.first_byte = time.time()
+            received += chunk
+        self._received()
+        return received
+
+    def alive(self, probe_timeout=None):
+        return True
+
+    def run_until(self, cmd, pattern, timeout=10.0):
+        # Same as run(), but returning as soon as the output matches, instead of after a fixed wait_ms
+        #  The rest of the output (if any) can then be read using read()
+        self.write(cmd)
+        return self.wait_for(pattern, timeout)
+
+    def run_many(self, commands):
+        # Returns one (output, exit_status) tuple per command. This default costs one round trip per command,
+        #  links able to send a whole batch at once override it
+        return [(self.run(cmd), None) for cmd in commands]
+
+    def close(self):
+        raise NotImplementedError()
+
+
+class UartReader(threading.Thread):
+    """
+        Drains a serial port continuously into a bounded ring buffer of lines (oldest lines are dropped when full)
+        Lines can be consumed (readline, drain, wait_line) and/or observed as they arrive (subscribe)
+    """
+
+    def __init__(self, port, max_lines=10000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.port = port
+        self.lines = collections.deque(maxlen=max_lines)
+        self.partial = b''
+        self.dropped = 0
+        self.last_rx = time.time()
+        self.condition = threading.Condition()
+        self.subscribers = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                data = self.port.read(self.port.in_waiting or 1)
+            except Exception as oops:
+                logging.error("UART reader stopped: %s" % str(oops))
+                break
+            if data:
+                self._feed(data)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def _feed(self, data):
+        with self.condition:
+            self.last_rx = time.time()
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            for line in lines:
+                if len(self.lines) == self.lines.maxlen:
+                    self.dropped += 1
+                self.lines.append(line + b'\n')
+            self.condition.notify_all()
+        for callback in list(self.subscribers):
+            for line in lines:
+                callback(str(line, 'utf-8', 'replace').strip())
+
+    def subscribe(self, callback):
+        # callback(line) is called from the reader thread for each received line
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def readline(self, timeout):
+        # Same behavior as serial.Serial.readline(): a complete line, or what was received before the timeout
+        with self.condition:
+            if not self.lines:
+                self.condition.wait_for(lambda: self.lines, timeout)
+            if self.lines:
+                return self.lines.popleft()
+            partial, self.partial = self.partial, b''
+            return partial
+
+    def drain(self):
+        # Returns all buffered data without blocking
+        with self.condition:
+            data = b''.join(self.lines) + self.partial
+            self.lines.clear()
+            self.partial = b''
+        return data
+
+    def wait_idle(self, idle_s, timeout=None):
+        # Waits until nothing has been received for idle_s
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            now = time.time()
+            quiet = now - self.last_rx
+            if quiet >= idle_s or (deadline is not None and now >= deadline):
+                return
+            time.sleep(idle_s - quiet)
+
+    def wait_line(self, match, timeout):
+        # Consumes lines until one matches (regex or predicate), returns it. Returns None on timeout
+        if not callable(match):
+            match = re.compile(match).search
+        deadline = time.time() + timeout
+        while True:
+            line = self.readline(max(0, deadline - time.time()))
+            if line.endswith(b'\n'):
+                text = str(line, 'utf-8', 'replace').strip()
+                if match(text):
+                    return text
+            elif line:
+                with self.condition:
+                    self.partial = line + self.partial
+            if time.time() >= deadline:
+                return None
+
 
 class Uart(AbstractConnection):
 
-    def __init__(self, nickname="uart", port=None, baudrate=115200, bytesize=8, parity='N', stopbits=1, timeout=0.1):
+    def __init__(self, nickname="uart", port=None, baudrate=115200, bytesize=8, parity='N', stopbits=1, timeout=0.1,
+                 framed=None, reader=False, fast_baudrate=None, binary=False):
         object.__init__(self)
         self.nickname = nickname
         self.conn = 'UART ' + str(port) + '/' + str(baudrate) + '/' + str(bytesize) + '/' + parity + '/' + str(stopbits)
+        # framed: True/False to force, None to detect if the agent shell supports end markers
+        self.framed = framed
+        self.response_timeout = 10.0
+        self.token = '%08x' % random.getrandbits(32)
+        self.sequence = 0
+        self.pending = None
+        self.partial = b''
+        self.echo = None
+        self.prompt = ''
+        self.exit_status = None
+        self.timeout = timeout
+        self.reader = None
+        # Binary framing (see wfx_frames.py): FrameLink, and ids of the requests written and not read yet
+        self.frames = None
+        self.requests = collections.deque()
+        if binary and reader:
+            raise Exception("%s: binary frames and reader both read the port, they can't be used together" %
+                            nickname)
         if port:
             self.configure(port, baudrate, bytesize, parity, stopbits, timeout)
+            if fast_baudrate:
+                self.set_baudrate(fast_baudrate)
+            if binary:
+                self.start_binary()
+            if reader:
+                self.start_reader()
             return
 
     def configure(self, port, baudrate=115200, bytesize=8, parity='N', stopbits=1, timeout=0.1):
         self.connection = None
         self.link = None
+        if load_serial() is None:
+            raise Exception("'serial'   is not installed. UART connection impossible for " + self.nickname)
         try:
             self.link = serial.Serial(port, baudrate, bytesize, parity, stopbits, timeout)
+            self.timeout = timeout
             self.connection = port
             if self is None:
                 raise Exception("%s %s" % (self.nickname, 'Can not connect to ' + port))
+            framed, self.framed = self.framed, False
             agent_reply = self.run('wfx_test_agent')
             if agent_reply == '':
                 agent_error = ' No \'wfx_test_agent\' on ' + port + '. Communication is OK, but we miss the agent!!'
                 raise Exception("%s %s" % (self.nickname, str(agent_error)))
+            self.framed = self._detect_framing() if framed is None else framed
+            if self.framed:
+                self.conn += ' (framed)'
         except serial.serialutil.SerialException as oops:
             if 'PermissionError' in str(oops):
                 uart_error = port + ' is present, but already used. Use \'uarts()\' to list available COM ports'
@@ -177,68 +1063,339 @@ class Uart(AbstractConnection):
                 print(uarts())
                 raise Exception("%s %s" % (self.nickname, str(uart_error)))
 
+    def set_baudrate(self, baudrate, confirm_s=2.0):
+        # Switches the agent console and the port to 'baudrate', checked by a round trip at the new rate.
+        #  Returns True if the new rate is used, False if both sides are back at the previous rate
+        previous = self.link.baudrate
+        res = self.run('wfx_test_agent set_baudrate %d %.1f' % (baudrate, confirm_s))
+        if 'switching' not in res:
+            logging.warning("%-13s baud rate kept at %d, no agent support: %s" % (self.nickname, previous, res))
+            return False
+        # The agent switches 0.2 s after replying
+        time.sleep(0.3)
+        self.link.baudrate = baudrate
+        self.link.reset_input_buffer()
+        self.partial = b''
+        if self._check_baudrate(baudrate):
+            self.conn = self.conn.replace('/' + str(previous) + '/', '/' + str(baudrate) + '/', 1)
+            logging.info("%-13s baud rate switched from %d to %d" % (self.nickname, previous, baudrate))
+            return True
+        # Unconfirmed: the agent goes back to the previous rate after confirm_s
+        time.sleep(confirm_s)
+        self.link.baudrate = previous
+        self.link.reset_input_buffer()
+        self.partial = b''
+        logging.warning("%-13s baud rate %d failed, back to %d" % (self.nickname, baudrate, previous))
+        if not self._check_baudrate(previous, confirm=False):
+            raise Exception("%s: no answer at %d baud after trying %d baud" % (self.nickname, previous, baudrate))
+        return False
+
+    def _check_baudrate(self, baudrate, confirm=True):
+        # Round trip at the current rate (garbled commands get no proper answer, nor end marker)
+        response_timeout, self.response_timeout = self.response_timeout, 1.0
+        try:
+            if confirm:
+                return str(baudrate) in self.run('wfx_test_agent confirm_baudrate').split()
+            return self.run('wfx_test_agent read_agent_version') != ''
+        except serial.serialutil.SerialException:
+            return False
+        finally:
+            self.response_timeout = response_timeout
+
+    def start_binary(self, command='wfx_frame_agent'):
+        # Switches to length-prefixed, CRC-checked frames (the agent shell runs 'command' to handle them).
+        #  Returns True if frames are used
+        if self.reader is not None:
+            raise Exception("%s: binary frames can't be used with a reader (stop_reader() first)" % self.nickname)
+        frames = FrameLink(self.link, self.response_timeout)
+        version = frames.start(command)
+        if version is None:
+            logging.warning("%-13s no binary framing agent, received: %s" %
+                            (self.nickname, str(frames.decoder.skipped, 'utf-8', 'replace').strip()))
+            self.link.reset_input_buffer()
+            return False
+        self.frames = frames
+        self.conn += ' (binary frames)'
+        logging.info("%-13s binary frames (wfx_frame_agent %s)" % (self.nickname, version))
+        return True
+
+    def stop_binary(self):
+        # Back to the agent shell
+        if self.frames is not None:
+            self.frames.stop()
+            self.frames = None
+            self.requests.clear()
+            self.conn = self.conn.replace(' (binary frames)', '')
+
+    def _frame_result(self, response):
+        out, err, self.exit_status = response
+        # As on the console, error messages are part of the result
+        return '\n'.join(res for res in [str(out, 'utf-8', 'replace').strip(), str(err, 'utf-8', 'replace').strip()]
+                         if res)
+
+    def start_reader(self, max_lines=10000):
+        if self.frames is not None:
+            # FrameLink reads the port itself
+            raise Exception("%s: no reader (nor wait_line()) with binary frames (stop_binary() first)" %
+                            self.nickname)
+        if self.reader is None and self.link is not None:
+            self.reader = UartReader(self.link, max_lines)
+            self.reader.start()
+        return self.reader
+
+    def stop_reader(self):
+        if self.reader is not None:
+            self.reader.stop()
+        self.reader = None
+
+    def wait_line(self, match, timeout=10.0):
+        return self.start_reader().wait_line(match, timeout)
+
+    def _readline(self):
+        if self.reader is not None:
+            data = self.reader.readline(self.timeout)
+        else:
+            data = self.link.readline()
+        if data and self.first_byte is None:
+            self.first_byte = time.time()
+        return data
+
+    def _marker(self):
+        self.sequence += 1
+        marker = '__wfx_%s_%d' % (self.token, self.sequence)
+        # The marker command never contains the marker itself (split by quotes), so its echo can't be mistaken
+        #  for the marker line printed by the agent shell
+        return marker + '__', 'echo "' + marker + '""__ $?"'
+
+    def _send_marker(self):
+        self.pending = self._marker()
+        self.link.write(bytes(self.pending[1] + '\n', 'utf-8'))
+
+    def _detect_framing(self):
+        self._send_marker()
+        lines, status, found = self._read_framed(timeout=1.0)
+        logging.info("%-13s %s" % (self.nickname, 'framed responses' if found else 'no end marker, using timeouts'))
+        return found
+
     def write(self, text):
+        if self.frames is not None:
+            if self.trace:
+                trace_sink.record(self.nickname, 'U', '>', text)
+            self._sending(text)
+            self.requests.append(self.frames.send(text.strip()))
+            self._sent()
+            return
         if self.link is not None:
             if self.trace:
-                for line in text.strip().split('\n'):
-                    print(str.format("%-8s U>>|  " % self.nickname), end='')
-                    print(line)
+                trace_sink.record(self.nickname, 'U', '>', text)
+            self._sending(text)
             self.link.write(bytes(text.strip() + '\n', 'utf-8'))
+            self.echo = text.strip()
+            if self.framed:
+                self._send_marker()
+            self._sent()
+
+    def _read_framed(self, timeout, echoes=()):
+        # Reads lines until the pending end marker, returns (lines, exit_status, marker found)
+        #  Lines ending with one of 'echoes' (commands sent in the same batch) are skipped
+        marker, marker_cmd = self.pending
+        self.pending = None
+        lines = []
+        partial, self.partial = self.partial, b''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            partial += self._readline()
+            if not partial.endswith(b'\n'):
+                continue
+            line = str(partial, "utf-8", "replace").strip()
+            partial = b''
+            if marker in line:
+                # The agent shell prompt may precede the marker on the same line
+                self.prompt = line[:line.index(marker)]
+                status = line[line.index(marker) + len(marker):].strip()
+                return lines, int(status) if re.match(r'^-?\d+$', status) else None, True
+            line = self._output_line(line, echoes)
+            if line is not None:
+                lines.append(line)
+        if partial:
+            lines.append(str(partial, "utf-8", "replace").strip())
+        return lines, None, False
+
+    def _output_line(self, line, echoes=()):
+        # Output line of a command, without the agent shell prompt printed before it. None for the echoes of
+        #  commands ('echoes') and of marker commands, and for markers of responses already partly read by wait_for()
+        line = line.strip()
+        for echo in echoes:
+            if echo and line.endswith(echo):
+                if len(line) > len(echo):
+                    # The echo follows the agent shell prompt
+                    self.prompt = line[:len(line) - len(echo)]
+                return None
+        if line == '' or '__wfx_' + self.token in line:
+            return None
+        prompt = self.prompt.strip()
+        if prompt and line.startswith(prompt):
+            line = line[len(prompt):].strip()
+        return line if line else None
+
+    def _read_response(self, echoes):
+        # Output lines of the pending command (see _read_framed()), its exit status being stored
+        lines, self.exit_status, found = self._read_framed(self.response_timeout, echoes)
+        if not found:
+            logging.warning("%s no end marker received after %.1f s" % (self.nickname, self.response_timeout))
+        if self.trace:
+            trace_sink.record(self.nickname, 'U', '<', '\n'.join(lines))
+        return lines
+
+    def _read_chunk(self, timeout):
+        if self.frames is not None:
+            # Responses come whole
+            response = self.frames.poll(self.requests[0], timeout) if self.requests else None
+            if response is None:
+                return ''
+            self.requests.popleft()
+            return self._frame_result(response)
+        deadline = time.time() + timeout
+        while self.link is not None:
+            self.partial += self._readline()
+            if self.partial.endswith(b'\n') or (self.partial and self.pending is None):
+                data, self.partial = self.partial, b''
+                line = str(data, 'utf-8', 'replace').replace('\r', '')
+                if self.pending is not None and self.pending[0] in line:
+                    # End of the command: read() has nothing more to wait for
+                    marker = self.pending[0]
+                    status = line[line.index(marker) + len(marker):].strip()
+                    self.exit_status = int(status) if re.match(r'^-?\d+$', status) else None
+                    self.pending = None
+                    self.echo = None
+                    continue
+                # As in read(), the command may be echoed more than once (such as again after the prompt)
+                output = self._output_line(line, [self.echo, self.pending[1] if self.pending is not None else None])
+                if output is None:
+                    continue
+                return output + '\n' if line.endswith('\n') else output
+            if time.time() >= deadline:
+                break
+        return ''
 
     def read(self):
         lines = ''
+        if self.frames is not None:
+            if self.requests:
+                lines = self._frame_result(self.frames.collect(self.requests.popleft()))
+                if self.trace:
+                    trace_sink.record(self.nickname, 'U', '<', lines)
+                self._received()
+            return lines
         if self.link is not None:
+            if self.pending is not None:
+                framed_lines = self._read_response([self.echo, self.pending[1]])
+                self.echo = None
+                self._received()
+                return '\n'.join(framed_lines)
+            if self.reader is not None:
+                # Whatever was already received, without blocking
+                lines = '\n'.join(line.strip() for line in str(self.reader.drain(), 'utf-8', 'replace').split('\n')
+                                  if line.strip())
+                if self.trace:
+                    trace_sink.record(self.nickname, 'U', '<', lines)
+                self._received()
+                return lines
             reading = True
             while reading:
-                line = str(self.link.readline(), "utf-8").strip()
+                line = str(self._readline(), "utf-8").strip()
                 if line == '':
                     reading = False
                 else:
                     if lines != '':
                         lines += '\n'
                     lines += line
-                    if self.trace:
-                        print(str.format('<<U %8s|  %s' % (self.nickname, line)))
+            if self.trace and lines:
+                trace_sink.record(self.nickname, 'U', '<', lines)
+            self._received()
         return lines
 
     def run(self, cmd, wait_ms=0):
         self.write(cmd)
         time.sleep(wait_ms/1000.0)
+        if self.reader is not None and self.pending is None:
+            # read() doesn't block with a reader: wait for the reply to be complete, as without reader
+            time.sleep(self.timeout)
+            self.reader.wait_idle(self.timeout)
         return self.read()
 
+    def run_many(self, commands):
+        if self.frames is not None:
+            # All requests are outstanding at once
+            for cmd in commands:
+                self.write(cmd)
+            return [(self.read(), self.exit_status) for cmd in commands]
+        if not self.framed or self.link is None:
+            return AbstractConnection.run_many(self, commands)
+        # Pipelined: all commands (each followed by its marker) are written at once, then the replies are
+        #  split on the markers. The agent shell echoes the next commands while busy: these echoes are skipped
+        pending = []
+        echoes = []
+        for cmd in commands:
+            self.write(cmd)
+            pending.append(self.pending)
+            echoes.append(cmd.strip())
+            echoes.append(self.pending[1])
+        self._sending('run_many')
+        self._sent()
+        results = []
+        for marker in pending:
+            self.pending = marker
+            lines = self._read_response(echoes)
+            results.append(('\n'.join(lines), self.exit_status))
+        self._received()
+        return results
+
+    def close(self):
+        self.stop_reader()
+        if self.link is not None:
+            self.stop_binary()
+            self.link.close()
+        self.link = None
+
 
 class Telnet(AbstractConnection):
 
-    def __init__(self, name=None, user="pi", host="10.5.124.249", password=None):
+    def __init__(self, name=None, user="pi", host="10.5.124.249", password=None, port=23, timeout=None):
         self.nickname = name if name else 'telnet'
         self.conn = 'TELNET ' + user + '@' + host
+        self.shell = None
+        self.exit_status = None
         super().__init__()
         if host:
-            self.configure(user=user, host=host, password=password)
+            self.configure(user=user, host=host, password=password, port=port, timeout=timeout)
 
-    def configure(self, user="pi", host="10.5.124.249", password=None):
-        self.link = telnetlib.Telnet(user)
-        self.link.read_until("login: ")
-        self.link.write(user + "\n")
-        if password:
-            self.link.read_until("Password: ")
-            self.link.write(password + "\n")
+    def configure(self, user="pi", host="10.5.124.249", password=None, port=23, timeout=None):
+        # A single session is used for all commands (opened again if it's lost), each command being framed.
+        #  timeout: per command timeout (s), after which the session is restarted
+        if load_telnetlib() is None:
+            raise Exception("'telnetlib'  is not installed. TELNET connection impossible for " + self.nickname)
+        self.shell = TelnetShell(host, user, password=password, port=port, timeout=timeout)
+        self.shell.open()
 
     def write(self, text):
-        if self.link is not None:
+        if self.shell is not None:
             if self.trace:
-                for line in text.strip().split('\n'):
-                    print(str.format("%-8s S>>|  " % self.nickname), end='')
-                    print(line)
-            self.link.write(bytes(text.strip() + '\n', 'utf-8'))
+                trace_sink.record(self.nickname, 'S', '>', text)
+            self._sending(text)
+            self.shell.send(text)
+            self._sent()
 
     def read(self):
-        if self.link is not None:
-            res = self.link.read_all()
+        if self.shell is not None:
+            out, err, self.exit_status = self.shell.collect()
+            self._received(self.shell.first_byte)
+            res = str(out, 'utf-8', 'replace').strip()
+            if self.shell.ended:
+                logging.warning("%s: the shell was closed by the command, a new one is opened by the next command" %
+                                self.nickname)
             if self.trace:
-                for line in res.split('\n'):
-                    print(str.format("<<S %8s|  " % self.nickname), end='')
-                    print(line)
+                trace_sink.record(self.nickname, 'S', '<', res)
             return res
         else:
             return ''
@@ -248,34 +1405,64 @@ class Telnet(AbstractConnection):
         time.sleep(wait_ms/1000.0)
         return self.read()
 
+    def run_many(self, commands):
+        if self.shell is None:
+            return [('', None) for cmd in commands]
+        if self.trace:
+            for cmd in commands:
+                trace_sink.record(self.nickname, 'S', '>', cmd)
+        self._sending('run_many')
+        self._sent()
+        results = [(str(out, 'utf-8', 'replace').strip(), status) for out, err, status in
+                   self.shell.execute_many(commands)]
+        self._received(self.shell.first_byte)
+        if self.trace:
+            for res, exit_status in results:
+                trace_sink.record(self.nickname, 'S', '<', res)
+        return results
+
+    def _read_chunk(self, timeout):
+        if self.shell is None:
+            return ''
+        return str(self.shell.stream(timeout), 'utf-8', 'replace')
+
+    def close(self):
+        if self.shell is not None:
+            self.shell.close()
+        self.shell = None
+
 
 class Ssh(AbstractConnection):
 
-    def __init__(self, name=None, user="pi", host="10.5.124.249", port=22, password=""):
+    def __init__(self, name=None, user="pi", host="10.5.124.249", port=22, password="", persistent=False,
+                 pooled=True):
         self.nickname = name if name else 'ssh'
         self.conn = 'SSH ' + user + '@' + host + ':' + str(port)
         super().__init__()
         if host:
-            self.configure(user=user, host=host, port=port, password=password)
+            self.configure(user=user, host=host, port=port, password=password, persistent=persistent, pooled=pooled)
 
-    def configure(self, user="pi", host="10.5.124.249", port=22, password="default_password"):
-        self.link = SshTarget(user=user, host=host, name=self.nickname, port=port, password=password)
+    def configure(self, user="pi", host="10.5.124.249", port=22, password="default_password", persistent=False,
+                  pooled=True):
+        self.link = SshTarget(user=user, host=host, name=self.nickname, port=port, password=password,
+                              persistent=persistent, pooled=pooled)
+        if persistent:
+            self.conn += ' (persistent shell)'
 
     def write(self, text):
         if self.link is not None:
             if self.trace:
-                for line in text.strip().split('\n'):
-                    print(str.format("%-8s S>>|  " % self.nickname), end='')
-                    print(line)
+                trace_sink.record(self.nickname, 'S', '>', text)
+            self._sending(text)
             self.link.write(bytes(text.strip() + '\n', 'utf-8'))
+            self._sent()
 
     def read(self):
         if self.link is not None:
             res = self.link.read()
+            self._received(self.link.first_byte)
             if self.trace:
-                for line in res.split('\n'):
-                    print(str.format("<<S %8s|  " % self.nickname), end='')
-                    print(line)
+                trace_sink.record(self.nickname, 'S', '<', res)
             return res
         else:
             return ''
@@ -285,13 +1472,85 @@ class Ssh(AbstractConnection):
         time.sleep(wait_ms/1000.0)
         return self.read()
 
+    def run_many(self, commands):
+        if self.link is None:
+            return [('', None) for cmd in commands]
+        if self.trace:
+            for cmd in commands:
+                trace_sink.record(self.nickname, 'S', '>', cmd)
+        self._sending('run_many')
+        self._sent()
+        results = self.link.run_many(commands)
+        self._received(self.link.first_byte)
+        if self.trace:
+            for res, exit_status in results:
+                trace_sink.record(self.nickname, 'S', '<', res)
+        return results
+
+    def _read_chunk(self, timeout):
+        if self.link is None:
+            return ''
+        return str(self.link.read_chunk(timeout), 'utf-8', 'replace')
+
+    def read_file(self, path):
+        # Contents of a remote file (such as a debugfs file), read over SFTP: no process is started on the target
+        if self.link is None:
+            return ''
+        if self.trace:
+            trace_sink.record(self.nickname, 'S', '>', 'read_file ' + path)
+        self._sending('read_file ' + path)
+        self._sent()
+        res = str(self.link.file(path, 'r'), 'utf-8', 'replace')
+        self._received(self.link.first_byte)
+        if self.trace:
+            trace_sink.record(self.nickname, 'S', '<', res)
+        return res
+
+    def write_file(self, path, text):
+        # Writes text to a remote file (such as debugfs 'send_pds') over SFTP, in a single write
+        #  Returns the number of bytes written (0 without link), SFTP errors are raised
+        if self.link is None:
+            return 0
+        if self.trace:
+            trace_sink.record(self.nickname, 'S', '>', 'write_file ' + path + ' ' + text)
+        data = bytes(text, 'utf-8')
+        self._sending('write_file ' + path)
+        self.link.file(path, 'w', data)
+        self._sent()
+        self._received()
+        return len(data)
+
+    def alive(self, probe_timeout=None):
+        return self.link is not None and self.link.alive(probe_timeout)
+
+    def reconnect(self):
+        if self.link is not None:
+            self.link.reconnect()
+
+    def connection_stats(self):
+        # Attempts (duration_s, error) and duration of the last connection, number of reconnections
+        if self.link is None:
+            return dict()
+        return dict(attempts=self.link.attempts, connect_s=self.link.connect_s, reconnects=self.link.reconnects)
+
+    def close(self):
+        if self.link is not None:
+            self.link.close()
+        self.link = None
+
 
 class Direct(AbstractConnection):
 
-    def __init__(self, name=None):
+    def __init__(self, name=None, persistent=False):
         self.nickname = name if name else 'direct'
         self.command_res = None
+        self.error = None
+        self.exit_status = None
         self.conn = 'Direct'
+        # persistent: all commands go to a single long-lived /bin/sh instead of one shell per command
+        self.shell = LocalShell() if persistent and os.name == 'posix' else None
+        if self.shell is not None:
+            self.conn += ' (persistent shell)'
         super().__init__()
 
     def configure(self, *args, **kwargs):
@@ -299,18 +1558,23 @@ class Direct(AbstractConnection):
 
     def write(self, text):
         if self.trace:
-            for line in text.strip().split('\n'):
-                print(str.format("%-8s D>>|  " % self.nickname), end='')
-                print(line)
-        self.command_res = os.popen(text).read().strip()
+            trace_sink.record(self.nickname, 'D', '>', text)
+        self._sending(text)
+        if self.shell is not None:
+            self.shell.send(text)
+        else:
+            self.command_res = os.popen(text).read().strip()
+        self._sent()
 
     def read(self):
+        if self.shell is not None and (self.shell.pending or self.shell.response is not None):
+            out, err, self.exit_status = self.shell.collect()
+            self._result(out, err)
+        self._received(self.shell.first_byte if self.shell is not None else None)
         if self.command_res:
             res = self.command_res
             if self.trace:
-                for line in res.split('\n'):
-                    print(str.format("<<D %8s|  " % self.nickname), end='')
-                    print(line)
+                trace_sink.record(self.nickname, 'D', '<', res)
             return res
         else:
             return ''
@@ -319,6 +1583,190 @@ class Direct(AbstractConnection):
         self.write(cmd)
         return self.read()
 
+    def run_many(self, commands):
+        if os.name != 'posix':
+            return AbstractConnection.run_many(self, commands)
+        self._sending('run_many')
+        self._sent()
+        if self.shell is not None:
+            responses = self.shell.execute_many(commands)
+        else:
+            # A single shell process for the whole batch
+            script, markers = FramedShell().script(commands)
+            process = subprocess.run(['/bin/sh'], input=script, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            responses = FramedShell.split(process.stdout, process.stderr, markers)
+        results = []
+        self._received(self.shell.first_byte if self.shell is not None else None)
+        for out, err, self.exit_status in responses:
+            self._result(out, err)
+            results.append((self.read(), self.exit_status))
+        return results
+
+    def _read_chunk(self, timeout):
+        if self.shell is not None:
+            return str(self.shell.stream(timeout), 'utf-8', 'replace')
+        # Without shell, the command already completed in write()
+        res, self.command_res = self.command_res, None
+        return res if res else ''
+
+    def _result(self, out, err):
+        # stderr is not part of the result, as with os.popen()
+        self.command_res = str(out, 'utf-8', 'replace').strip()
+        self.error = str(err, 'utf-8', 'replace').strip()
+        sys.stderr.write(str(err, 'utf-8', 'replace'))
+
+    def close(self):
+        if self.shell is not None:
+            self.shell.close()
+
+
+class Native(Direct):
+    """
+        Direct link running the debugfs wfx_test_agent options (write_test_data, read_rx_stats, read_fw_version)
+         in-process, on debugfs files opened once. Other commands go to the shell as with Direct, as do all
+         commands when debugfs is not accessible (not root, driver not loaded)
+    """
+
+    def __init__(self, name=None, persistent=False, debugfs='/sys/kernel/debug/ieee80211/phy*/wfx'):
+        super().__init__(name, persistent)
+        self.debugfs = debugfs
+        # Resolved wfx debugfs directory: None until first use, False if it can't be used
+        self.root = None
+        self.fds = dict()
+        # True while the last command written was run natively
+        self.handled = False
+        self.options = {'write_test_data': self._write_test_data,
+                        'read_rx_stats': self._read_rx_stats,
+                        'read_fw_version': self._read_fw_version}
+        self.conn += ' (native debugfs)'
+
+    def _fd(self, name, flags):
+        if (name, flags) not in self.fds:
+            if self.root is None:
+                roots = sorted(glob.glob(self.debugfs))
+                if not roots:
+                    # No wfx debugfs on this host: all commands go to the agent
+                    self.root = False
+                    raise FileNotFoundError(self.debugfs)
+                self.root = roots[0]
+            self.fds[(name, flags)] = os.open(os.path.join(self.root, name), flags)
+        return self.fds[(name, flags)]
+
+    def _read_file(self, name):
+        # pread() from offset 0 makes the driver generate the file contents again
+        fd = self._fd(name, os.O_RDONLY)
+        chunks = []
+        offset = 0
+        while True:
+            data = os.pread(fd, 65536, offset)
+            if not data:
+                break
+            chunks.append(data)
+            offset += len(data)
+        return str(b''.join(chunks), 'utf-8', 'replace')
+
+    def _write_test_data(self, data):
+        # send_pds only accepts a whole write at offset 0
+        os.pwrite(self._fd('send_pds', os.O_WRONLY), bytes(data + '\n', 'utf-8'), 0)
+        return "'" + data + "' sent to " + os.path.join(self.root, 'send_pds')
+
+    def _read_rx_stats(self):
+        return self._read_file('rx_stats')
+
+    def _read_fw_version(self):
+        versions = re.findall(r'Firmware:.* WFM(.*)', self._read_file('status'))
+        return '.'.join(' '.join(versions).split())
+
+    def _option(self, cmd):
+        # (option, arguments) of a wfx_test_agent command run natively, None otherwise
+        if self.root is False or not hasattr(os, 'pread'):
+            return None
+        try:
+            words = shlex.split(cmd)
+        except ValueError:
+            return None
+        if words[:1] == ['sudo']:
+            words = words[1:]
+        if len(words) < 2 or words[0] != 'wfx_test_agent' or words[1] not in self.options:
+            return None
+        return words[1], words[2:]
+
+    def _native(self, option):
+        # Response of the option (see _option()) run natively, None if it has to go to the agent
+        try:
+            return self.options[option[0]](*option[1])
+        except PermissionError:
+            self.close_files()
+            self.root = False
+        except (OSError, TypeError):
+            # Driver reloaded, bad arguments...: the agent reports it, debugfs is resolved again next time
+            self.close_files()
+        return None
+
+    def write(self, text):
+        res = None
+        option = None
+        if self.shell is None or not (self.shell.pending or self.shell.response is not None):
+            option = self._option(text)
+        if option is not None:
+            # Other commands are recorded by Direct.write()
+            self._sending(text)
+            res = self._native(option)
+        self.handled = res is not None
+        if not self.handled:
+            return super().write(text)
+        if self.trace:
+            trace_sink.record(self.nickname, 'D', '>', text)
+        self.command_res = res.strip()
+        self.error = ''
+        self.exit_status = 0
+        self._sent()
+
+    def read(self):
+        if not self.handled:
+            return super().read()
+        self.handled = False
+        self._received()
+        res, self.command_res = self.command_res, None
+        if self.trace:
+            trace_sink.record(self.nickname, 'D', '<', res)
+        return res
+
+    def run_many(self, commands):
+        # Consecutive agent commands are batched as with Direct, native ones are run in order in between
+        results = []
+        batch = []
+        for cmd in commands:
+            if self._option(cmd) is None:
+                batch.append(cmd)
+                continue
+            if batch:
+                results.extend(Direct.run_many(self, batch))
+                batch = []
+            self.write(cmd)
+            results.append((self.read(), self.exit_status))
+        if batch:
+            results.extend(Direct.run_many(self, batch))
+        return results
+
+    def _read_chunk(self, timeout):
+        if self.handled:
+            self.handled = False
+            res, self.command_res = self.command_res, None
+            return res
+        return super()._read_chunk(timeout)
+
+    def close_files(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = dict()
+        if self.root:
+            self.root = None
+
+    def close(self):
+        self.close_files()
+        super().close()
+
 
 class WfxConnection(object):
 
@@ -340,46 +1788,52 @@ class WfxConnection(object):
 
         if not self.link:
             if 'host' in kwargs:
-                if not loaded_paramiko:
+                if load_paramiko() is None:
                     raise Exception("'paramiko'   is not installed. SSH connection impossible for " + nickname)
                 host = kwargs['host']
                 port = kwargs['port'] if 'port' in kwargs else 22
                 user = kwargs['user'] if 'user' in kwargs else 'root'
                 print('%s: Configuring a SSH connection to host %s for user %s' % (nickname, host, user))
                 password = kwargs['password'] if 'password' in kwargs else None
-                self.link = Ssh(nickname, host=host, user=user, port=port, password=password)
+                persistent = kwargs['persistent'] if 'persistent' in kwargs else False
+                self.link = Ssh(nickname, host=host, user=user, port=port, password=password, persistent=persistent)
 
         if not self.link:
             if 'port' in kwargs:
-                if not loaded_serial:
+                if load_serial() is None:
                     raise Exception("'serial'   is not installed. UART connection impossible for " + nickname)
                 port = kwargs['port']
                 print('%s: Configuring a UART connection using %s' % (nickname, port))
-                self.link = Uart(nickname, port=port)
+                framed = kwargs['framed'] if 'framed' in kwargs else None
+                reader = kwargs['reader'] if 'reader' in kwargs else False
+                fast_baudrate = kwargs['fast_baudrate'] if 'fast_baudrate' in kwargs else None
+                binary = kwargs['binary'] if 'binary' in kwargs else False
+                self.link = Uart(nickname, port=port, framed=framed, reader=reader, fast_baudrate=fast_baudrate,
+                                 binary=binary)
                 if self.link is None:
                     if port in uarts():
                         raise Exception(port + ' is detected but is not available. Check for other applications using ' + port)
 
         if not self.link:
-            if not kwargs:
+            if not [key for key in kwargs if key not in ['persistent', 'native']]:
                 print('%s: Configuring a Direct connection' % nickname)
-                self.link = Direct(nickname)
+                persistent = kwargs['persistent'] if 'persistent' in kwargs else False
+                if 'native' in kwargs and kwargs['native']:
+                    self.link = Native(nickname, persistent=persistent)
+                else:
+                    self.link = Direct(nickname, persistent=persistent)
 
     def write(self, text):
         if self.link is not None:
             if self.trace:
-                for line in text.strip().split('\n'):
-                    print(str.format("%-8s S>>|  " % self.nickname), end='')
-                    print(line)
-            self.link.write(bytes(text.strip() + '\n', 'utf-8'))
+                trace_sink.record(self.nickname, 'S', '>', text)
+            self.link.write(text)
 
     def read(self):
         if self.link is not None:
             res = self.link.read()
             if self.trace:
-                for line in res.split('\n'):
-                    print(str.format("<<S %8s|  " % self.nickname), end='')
-                    print(line)
+                trace_sink.record(self.nickname, 'S', '<', res)
             return res
         else:
             return ''
@@ -389,23 +1843,119 @@ class WfxConnection(object):
         time.sleep(wait_ms/1000.0)
         return self.read()
 
+    def run_many(self, commands):
+        if self.link is None:
+            return [('', None) for cmd in commands]
+        if self.trace:
+            for cmd in commands:
+                trace_sink.record(self.nickname, 'S', '>', cmd)
+        results = self.link.run_many(commands)
+        if self.trace:
+            for res, exit_status in results:
+                trace_sink.record(self.nickname, 'S', '<', res)
+        return results
+
+    @property
+    def conn(self):
+        return self.link.conn if self.link is not None else ''
+
+    @property
+    def latency(self):
+        return self.link.latency if self.link is not None else LinkLatency(self.nickname)
+
+    def wait_for(self, pattern, timeout=10.0):
+        if self.link is None:
+            raise LinkTimeout(self.nickname, pattern, 0, '')
+        return self.link.wait_for(pattern, timeout)
+
+    def run_until(self, cmd, pattern, timeout=10.0):
+        self.write(cmd)
+        return self.wait_for(pattern, timeout)
+
+    def alive(self, probe_timeout=None):
+        return self.link is not None and self.link.alive(probe_timeout)
+
+    def close(self):
+        if self.link is not None:
+            self.link.close()
+        self.link = None
+
 
 # Functions allowing discovery of possible connections
+UartPort = collections.namedtuple('UartPort', ['device', 'vid', 'pid', 'serial_number', 'description', 'busy'])
+
+# Port probing (opening each port) is cached for uart_cache_ttl_s, or until a port appears/disappears
+uart_cache_ttl_s = 5.0
+uart_cache = {'devices': None, 'ports': [], 'time': 0}
+uart_lock = threading.Lock()
+
+
+def _uart_busy(device):
+    # True if another application uses the port, False if it's free, None if it can't be opened at all
+    try:
+        serial.Serial(device).close()
+    except serial.serialutil.SerialException as oops:
+        return True if 'PermissionError' in str(oops) else None
+    return False
+
+
+def uart_ports(refresh=False):
+    """
+        UartPort records for all UARTs: device, USB vid/pid and serial_number (None if not USB), description, busy
+    """
+    if load_serial() is None:
+        return []
+    from serial.tools import list_ports
+    from concurrent.futures import ThreadPoolExecutor
+    infos = sorted(list_ports.comports(), key=lambda info: info.device)
+    devices = [info.device for info in infos]
+    with uart_lock:
+        if not refresh and uart_cache['devices'] == devices and time.time() - uart_cache['time'] < uart_cache_ttl_s:
+            return list(uart_cache['ports'])
+    busy = []
+    if devices:
+        with ThreadPoolExecutor(max_workers=min(32, len(devices))) as executor:
+            busy = list(executor.map(_uart_busy, devices))
+    ports = [UartPort(info.device, info.vid, info.pid, info.serial_number, info.description, in_use)
+             for info, in_use in zip(infos, busy)]
+    with uart_lock:
+        uart_cache.update(devices=devices, ports=ports, time=time.time())
+    return list(ports)
+
+
+def uart_device(serial_number):
+    # Device name (such as 'COM8' or '/dev/ttyUSB0') of the USB UART with this serial number, None if not plugged
+    for port in uart_ports():
+        if port.serial_number is not None and port.serial_number.lower() == serial_number.lower():
+            return port.device
+    return None
+
+
 def uarts():
-    if loaded_serial == 0:
+    if load_serial() is None:
         return "'serial' is not installed. Can't list UARTs"
-    com_ports = os.popen('python -m serial.tools.list_ports').read().replace(' ', '').strip().split('\n')
     res = ''
-    for port in com_ports:
-        try:
-            serial.Serial(port)
-        except serial.serialutil.SerialException as oops:
-            if 'PermissionError' in str(oops):
-                res += '%-5s (IN USE)\n' % port
-        else:
-            res += '%-5s (free)\n' % port
-        finally:
-            pass
+    for port in uart_ports():
+        if port.busy is not None:
+            res += '%-5s (%s)\n' % (port.device, 'IN USE' if port.busy else 'free')
+    return res.strip()
+
+
+def ssh_transports():
+    stats = ssh_pool.stats()
+    res = str.format("pool: %d hits, %d misses, %d open (%d in use), %d closed\n" %
+                     (stats['hits'], stats['misses'], stats['open'], stats['in_use'], stats['closed']))
+    with ssh_pool.lock:
+        for (host, port, user), entry in ssh_pool.entries.items():
+            state = 'in use by %d' % entry['refs'] if entry['refs'] else 'idle'
+            res += str.format("%-30s %s\n" % ('%s@%s:%d' % (user, host, port), state))
+    return res.strip()
+
+
+def backends():
+    res = ''
+    for name, load in [('serial', load_serial), ('paramiko', load_paramiko), ('telnetlib', load_telnetlib)]:
+        res += str.format("%-10s %s\n" % (name, 'loaded' if load() is not None else 'not installed'))
     return res.strip()
 
 
@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+#
+# asyncio counterpart of the WFX connection layer
+#  Allows driving many DUTs from a single thread, using asyncio.gather()
+#
+import asyncio
+
+from wfx_connection import *
+
+
+async def _wait_readable(fileno, timeout):
+    # Waits until fileno is readable (or timeout). Event loops without add_reader (Windows proactor) are polled
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    try:
+        loop.add_reader(fileno, ready.set)
+    except (NotImplementedError, ValueError):
+        await asyncio.sleep(0.001 if timeout is None else min(0.001, timeout))
+        return
+    try:
+        await asyncio.wait_for(ready.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(fileno)
+
+
+class AsyncAbstractConnection(LatencyHooks):
+    link = None
+    connection = None
+    nickname = ''
+    trace = False
+    conn = ''
+
+    async def configure(self, *args, **kwargs):
+        raise NotImplementedError()
+
+    async def write(self, text):
+        raise NotImplementedError()
+
+    async def read(self):
+        raise NotImplementedError()
+
+    async def run(self, cmd, wait_ms=0):
+        await self.write(cmd)
+        await asyncio.sleep(wait_ms/1000.0)
+        return await self.read()
+
+    async def close(self):
+        raise NotImplementedError()
+
+    def _trace_out(self, tag, text):
+        if self.trace:
+            trace_sink.record(self.nickname, tag, '>', text)
+
+    def _trace_in(self, tag, text):
+        if self.trace:
+            trace_sink.record(self.nickname, tag, '<', text)
+
+
+class AsyncUart(AsyncAbstractConnection):
+
+    def __init__(self, nickname="uart", port=None, baudrate=115200, bytesize=8, parity='N', stopbits=1, timeout=0.1):
+        self.nickname = nickname
+        self.port = port
+        self.settings = (baudrate, bytesize, parity, stopbits)
+        self.timeout = timeout
+        self.buffer = b''
+        self.conn = 'UART ' + str(port) + '/' + str(baudrate) + '/' + str(bytesize) + '/' + parity + '/' + str(stopbits)
+
+    async def configure(self):
+        baudrate, bytesize, parity, stopbits = self.settings
+        if load_serial() is None:
+            raise Exception("'serial'   is not installed. UART connection impossible for " + self.nickname)
+        # timeout=0: reads return immediately with whatever is available
+        self.link = load_serial().Serial(self.port, baudrate, bytesize, parity, stopbits, timeout=0)
+        self.connection = self.port
+        agent_reply = await self.run('wfx_test_agent')
+        if agent_reply == '':
+            agent_error = ' No \'wfx_test_agent\' on ' + self.port + '. Communication is OK, but we miss the agent!!'
+            raise Exception("%s %s" % (self.nickname, str(agent_error)))
+
+    async def _fill(self, timeout):
+        # Appends available bytes to the buffer, waiting up to timeout for some. Returns False on timeout
+        data = self.link.read(self.link.in_waiting or 1)
+        if not data:
+            try:
+                fileno = self.link.fileno()
+            except (AttributeError, OSError):
+                fileno = None
+            deadline = time.time() + timeout
+            while not data and time.time() < deadline:
+                if fileno is not None:
+                    await _wait_readable(fileno, deadline - time.time())
+                else:
+                    await asyncio.sleep(0.001)
+                data = self.link.read(self.link.in_waiting or 1)
+        if data and self.first_byte is None:
+            self.first_byte = time.time()
+        self.buffer += data
+        return len(data) > 0
+
+    async def write(self, text):
+        if self.link is not None:
+            self._trace_out('U', text)
+            self._sending(text)
+            self.link.write(bytes(text.strip() + '\n', 'utf-8'))
+            self._sent()
+
+    async def read(self):
+        # Same as Uart.read(): everything received until the line is idle for 'timeout'
+        lines = []
+        if self.link is not None:
+            while await self._fill(self.timeout):
+                pass
+            data, self.buffer = self.buffer, b''
+            for line in str(data, 'utf-8', 'replace').split('\n'):
+                if line.strip():
+                    lines.append(line.strip())
+        self._received()
+        res = '\n'.join(lines)
+        if res:
+            self._trace_in('U', res)
+        return res
+
+    async def close(self):
+        if self.link is not None:
+            self.link.close()
+        self.link = None
+
+
+class AsyncSshShell(SshShell):
+    # Non-blocking version of SshShell: only collect() differs, waiting on the channel from the event loop
+
+    async def collect_async(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        response = self._current()
+        if response is None:
+            return b'', b'', None
+        deadline = None if timeout is None else time.time() + timeout
+        while not response.done:
+            channel = self.channel
+            if channel is None:
+                break
+            if channel.recv_ready():
+                self._feed(response, 1, channel.recv(65536))
+            elif channel.recv_stderr_ready():
+                self._feed(response, 2, channel.recv_stderr(65536))
+            elif channel.closed or channel.exit_status_ready():
+                self.close()
+                break
+            else:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    logging.warning("shell command timed out after %.3f s, restarting the shell" % timeout)
+                    self.close()
+                    break
+                await _wait_readable(channel.fileno(), remaining)
+        self.response = None
+        self.exit_status = response.status
+        return response.out[self.streamed:], response.err, response.status
+
+
+class AsyncSsh(AsyncAbstractConnection):
+
+    def __init__(self, name=None, user="pi", host="10.5.124.249", port=22, password=""):
+        self.nickname = name if name else 'ssh'
+        self.params = dict(user=user, host=host, port=port, password=password)
+        self.shell = None
+        self.result = None
+        self.error = None
+        self.exit_status = None
+        self.conn = 'SSH ' + user + '@' + host + ':' + str(port) + ' (async)'
+
+    async def configure(self):
+        # The SSH handshake itself is blocking: run it once in an executor, all commands are then non-blocking
+        loop = asyncio.get_running_loop()
+        self.link = await loop.run_in_executor(None, lambda: SshTarget(name=self.nickname, **self.params))
+        self.shell = AsyncSshShell(self.link.client)
+
+    async def write(self, text):
+        if self.shell is not None:
+            self._trace_out('S', text)
+            self._sending(text)
+            # Opening (or reopening) the shell runs open_session() and exec_command(): keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.shell.send, text)
+            self._sent()
+
+    async def read(self):
+        if self.shell is None:
+            return ''
+        out, err, self.exit_status = await self.shell.collect_async()
+        self._received(self.shell.first_byte)
+        self.result = str(out, "utf-8").strip()
+        self.error = str(err, "utf-8").strip()
+        res = self.result if self.result else "ERROR: " + self.error
+        self._trace_in('S', res)
+        return res
+
+    async def close(self):
+        if self.shell is not None:
+            self.shell.close()
+        if self.link is not None:
+            self.link.close()
+        self.shell = None
+        self.link = None
+
+
+class AsyncDirect(AsyncAbstractConnection):
+
+    def __init__(self, name=None):
+        self.nickname = name if name else 'direct'
+        self.process = None
+        self.conn = 'Direct (async)'
+
+    async def configure(self, *args, **kwargs):
+        pass
+
+    async def write(self, text):
+        self._trace_out('D', text)
+        self._sending(text)
+        self.process = await asyncio.create_subprocess_shell(text, stdout=asyncio.subprocess.PIPE)
+        self._sent()
+
+    async def read(self):
+        if self.process is None:
+            return ''
+        out, err = await self.process.communicate()
+        self._received()
+        self.process = None
+        res = str(out, 'utf-8', 'replace').strip()
+        if res:
+            self._trace_in('D', res)
+        return res
+
+    async def close(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+        self.process = None
+
+
+class AsyncWfxConnection(object):
+    """
+        Same connection selection as WfxConnection (host -> SSH, port -> UART, nothing -> Direct),
+         with awaitable methods. Call 'await connect()' before use
+    """
+
+    def __init__(self, nickname, **kwargs):
+        self.nickname = nickname
+        self.link = None
+
+        if 'host' in kwargs:
+            host = kwargs['host']
+            port = kwargs['port'] if 'port' in kwargs else 22
+            user = kwargs['user'] if 'user' in kwargs else 'root'
+            password = kwargs['password'] if 'password' in kwargs else None
+            self.link = AsyncSsh(nickname, host=host, user=user, port=port, password=password)
+        elif 'port' in kwargs:
+            settings = dict((k, kwargs[k]) for k in ['baudrate', 'bytesize', 'parity', 'stopbits'] if k in kwargs)
+            self.link = AsyncUart(nickname, port=kwargs['port'], **settings)
+        else:
+            self.link = AsyncDirect(nickname)
+        self.conn = self.link.conn
+
+    @property
+    def trace(self):
+        return self.link.trace
+
+    @property
+    def latency(self):
+        return self.link.latency
+
+    @trace.setter
+    def trace(self, value):
+        self.link.trace = value
+
+    async def connect(self):
+        print('%s: Configuring a %s connection' % (self.nickname, self.conn))
+        await self.link.configure()
+        return self
+
+    async def write(self, text):
+        await self.link.write(text)
+
+    async def read(self):
+        return await self.link.read()
+
+    async def run(self, cmd, wait_ms=0):
+        return await self.link.run(cmd, wait_ms)
+
+    async def close(self):
+        await self.link.close()
+
+
+if __name__ == '__main__':
+
+    async def main():
+        links = [AsyncWfxConnection('Local%d' % i) for i in range(4)]
+        await asyncio.gather(*(link.connect() for link in links))
+        start = time.time()
+        replies = await asyncio.gather(*(link.run('sleep 1; uname -n') for link in links))
+        print(replies)
+        print('%d commands of 1 s each completed in %.2f s' % (len(links), time.time() - start))
+
+    asyncio.run(main())
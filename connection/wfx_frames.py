@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+#
+# Binary framing of the agent traffic over serial links, used by Uart(..., binary=True) on the tools side and by
+#  wfx_frame_agent (test-feature/wfx_test_agent/linux) on the DUT side
+#
+#  Frame: sync (A5 5A) | type (1 byte) | request id (2 bytes) | payload length (4 bytes) | payload | CRC32 (4 bytes)
+#   Numbers are big-endian, the CRC covers type, request id, length and payload.
+#  Responses carry the id of their request, so that several requests can be outstanding
+#
+import time
+import zlib
+import struct
+import logging
+import collections
+
+SYNC = b'\xa5\x5a'
+HEADER = struct.Struct('>BHI')
+CRC = struct.Struct('>I')
+RESPONSE = struct.Struct('>iI')
+# Longer payloads are considered as corrupted headers
+MAX_PAYLOAD = 1 << 20
+
+FRAME_HELLO = ord('H')       # agent -> tools: binary mode started, payload: agent version
+FRAME_REQUEST = ord('Q')     # tools -> agent: command line
+FRAME_RESPONSE = ord('R')    # agent -> tools: exit status, stdout, stderr (see encode_response())
+FRAME_EXIT = ord('X')        # tools -> agent: back to the text shell
+FRAME_NAK = ord('N')         # agent -> tools: corrupted data received, outstanding requests must be sent again
+
+
+def encode_frame(kind, request_id, payload=b''):
+    if len(payload) > MAX_PAYLOAD:
+        raise Exception("frame payload too large (%d bytes, max %d)" % (len(payload), MAX_PAYLOAD))
+    body = HEADER.pack(kind, request_id, len(payload)) + payload
+    return SYNC + body + CRC.pack(zlib.crc32(body))
+
+
+def encode_response(status, out, err):
+    return RESPONSE.pack(status, len(out)) + out + err
+
+
+def decode_response(payload):
+    # (stdout, stderr, exit status) of a response payload
+    status, out_len = RESPONSE.unpack_from(payload)
+    return payload[RESPONSE.size:RESPONSE.size + out_len], payload[RESPONSE.size + out_len:], status
+
+
+class FrameDecoder(object):
+    """
+        Extracts frames from a byte stream. Data which isn't part of a valid frame (shell text, corrupted frames)
+         is skipped, corrupted frames being counted
+    """
+
+    def __init__(self):
+        self.data = b''
+        self.corrupted = 0
+        # Last skipped data (such as the shell output before the agent started), for error messages
+        self.skipped = b''
+
+    def _skip(self, length):
+        if length > 0:
+            self.skipped = (self.skipped + self.data[:length])[-1024:]
+            self.data = self.data[length:]
+
+    def feed(self, data):
+        # Returns the (type, request id, payload) frames completed by data
+        self.data += data
+        frames = []
+        while True:
+            start = self.data.find(SYNC)
+            if start < 0:
+                # A sync byte at the end may be the start of the next frame
+                self._skip(len(self.data) - (1 if self.data.endswith(SYNC[:1]) else 0))
+                return frames
+            self._skip(start)
+            if len(self.data) < len(SYNC) + HEADER.size:
+                return frames
+            kind, request_id, length = HEADER.unpack_from(self.data, len(SYNC))
+            if length > MAX_PAYLOAD:
+                self.corrupted += 1
+                self._skip(1)
+                continue
+            end = len(SYNC) + HEADER.size + length + CRC.size
+            if len(self.data) < end:
+                return frames
+            body = self.data[len(SYNC):end - CRC.size]
+            if CRC.unpack_from(self.data, end - CRC.size)[0] != zlib.crc32(body):
+                self.corrupted += 1
+                self._skip(1)
+                continue
+            frames.append((kind, request_id, body[HEADER.size:]))
+            self.data = self.data[end:]
+
+
+class FrameLink(object):
+    """
+        Tools side of the binary framing, over a serial port (pyserial like: write(), read(), in_waiting).
+        Requests are written at once, each with its own id, and responses are matched by id.
+        When corrupted data is received, or when no response arrives in time, the outstanding requests are sent
+         again: the agent answers repeated requests from its cache, without running the commands again
+    """
+
+    def __init__(self, port, timeout=10.0, retries=1):
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.decoder = FrameDecoder()
+        self.next_id = 0
+        # Request frame of each outstanding request id, and responses received but not collected yet
+        self.outstanding = collections.OrderedDict()
+        self.responses = dict()
+        self.hello = None
+        self.resent = 0
+
+    def _new_id(self):
+        self.next_id = self.next_id % 0xffff + 1
+        return self.next_id
+
+    def _receive(self):
+        # Reads what is available (waiting up to the port timeout for more), dispatching the frames received
+        data = self.port.read(max(1, self.port.in_waiting))
+        corrupted = self.decoder.corrupted
+        for kind, request_id, payload in self.decoder.feed(data):
+            if kind == FRAME_HELLO:
+                self.hello = str(payload, 'utf-8', 'replace')
+            elif kind == FRAME_RESPONSE and request_id in self.outstanding:
+                del self.outstanding[request_id]
+                self.responses[request_id] = decode_response(payload)
+            elif kind == FRAME_NAK:
+                corrupted = -1
+        if self.decoder.corrupted != corrupted:
+            logging.warning("corrupted frame %s, sending %d outstanding request(s) again" %
+                            ('sent' if corrupted < 0 else 'received', len(self.outstanding)))
+            self._resend()
+
+    def _resend(self):
+        for frame in self.outstanding.values():
+            self.port.write(frame)
+            self.resent += 1
+
+    def start(self, command='wfx_frame_agent', timeout=5.0):
+        # Starts the agent from the shell, returns its version (None if it didn't start)
+        self.hello = None
+        self.port.write(bytes(command + '\n', 'utf-8'))
+        deadline = time.time() + timeout
+        while self.hello is None and time.time() < deadline:
+            self._receive()
+        return self.hello
+
+    def stop(self):
+        self.port.write(encode_frame(FRAME_EXIT, 0))
+        self.outstanding.clear()
+        self.responses.clear()
+
+    def send(self, cmd):
+        request_id = self._new_id()
+        frame = encode_frame(FRAME_REQUEST, request_id, bytes(cmd, 'utf-8') if isinstance(cmd, str) else cmd)
+        self.outstanding[request_id] = frame
+        self.port.write(frame)
+        return request_id
+
+    def poll(self, request_id, timeout):
+        # (stdout, stderr, exit status) of request_id if received within timeout, None otherwise
+        deadline = time.time() + timeout
+        while request_id not in self.responses:
+            if request_id not in self.outstanding:
+                raise Exception("frame request %d was never sent" % request_id)
+            if time.time() >= deadline:
+                return None
+            self._receive()
+        return self.responses.pop(request_id)
+
+    def collect(self, request_id, timeout=None):
+        # (stdout, stderr, exit status) of request_id, (b'', b'', None) if it didn't come after all retries
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(self.retries + 1):
+            if attempt:
+                logging.warning("no response to frame request %d after %.1f s, sending it again" %
+                                (request_id, timeout))
+                self.port.write(self.outstanding[request_id])
+                self.resent += 1
+            response = self.poll(request_id, timeout)
+            if response is not None:
+                return response
+        del self.outstanding[request_id]
+        return b'', b'', None
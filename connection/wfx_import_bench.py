@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+#
+# Startup cost of the connection layer, and of each link backend (loaded on first use of a link of that type)
+#  Each measurement is done in a fresh python process, so that nothing is already imported
+#
+#  Use: python3 wfx_import_bench.py [repeat]
+#
+import os
+import sys
+import subprocess
+
+cases = [
+    ('wfx_connection', ''),
+    ('+ serial (UART)', 'load_serial()'),
+    ('+ paramiko (SSH)', 'load_paramiko()'),
+    ('+ telnetlib (TELNET)', 'load_telnetlib()'),
+]
+
+script = """
+import time
+start = time.perf_counter()
+from wfx_connection import *
+imported = time.perf_counter()
+loaded = %s
+print('%%.6f %%.6f %%s' %% (imported - start, time.perf_counter() - imported, loaded is not None))
+"""
+
+
+def measure(load, repeat):
+    # Returns the median import time, the median backend load time and the backend availability
+    imports = []
+    loads = []
+    available = True
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', script % (load if load else 'True')], cwd=os.path.dirname(
+            os.path.abspath(__file__)), stdout=subprocess.PIPE, check=True).stdout.split()
+        imports.append(float(out[0]))
+        loads.append(float(out[1]))
+        available = out[2] == b'True'
+    return sorted(imports)[repeat // 2], sorted(loads)[repeat // 2], available
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('%-22s %10s %10s' % ('', 'import ms', 'load ms'))
+    for name, load in cases:
+        imported, loaded, available = measure(load, repeat)
+        print('%-22s %10.1f %10s' % (name, imported * 1000, '%.1f' % (loaded * 1000) if load and available else
+                                     ('not installed' if load else '')))
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+#
+# Fixed-memory latency histograms, recorded by each link for every command
+#
+import json
+import time
+
+# Buckets: 4 per power of 2 of the latency in µs (values are within 25% of their bucket), up to ~12 days
+SUB_BUCKETS = 4
+NB_BUCKETS = 40 * SUB_BUCKETS
+# Commands are accounted per verb, up to MAX_VERBS verbs (then under 'other') to keep memory bounded
+MAX_VERBS = 64
+
+
+def command_verb(cmd):
+    # 'wfx_test_agent read_rx_stats' -> 'read_rx_stats', 'wfx_exec wfx_hif_send_msg "..."' -> 'wfx_hif_send_msg'
+    words = str(cmd).split()
+    if not words:
+        return ''
+    if words[0] in ['wfx_test_agent', 'wfx_exec', 'sudo'] and len(words) > 1:
+        return words[1]
+    return words[0].split('/')[-1]
+
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.counts = [0] * NB_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def _bucket(us):
+        if us < SUB_BUCKETS:
+            return us
+        exp = us.bit_length() - 3
+        return min(NB_BUCKETS - 1, (exp + 1) * SUB_BUCKETS + ((us >> exp) & (SUB_BUCKETS - 1)))
+
+    @staticmethod
+    def _bucket_max(index):
+        # Highest value (µs) falling in bucket 'index'
+        if index < SUB_BUCKETS:
+            return index
+        exp = index // SUB_BUCKETS - 1
+        return ((SUB_BUCKETS + index % SUB_BUCKETS + 1) << exp) - 1
+
+    def add(self, seconds):
+        us = max(0, int(seconds * 1000000))
+        self.counts[self._bucket(us)] += 1
+        self.count += 1
+        self.total += us
+        if self.min is None or us < self.min:
+            self.min = us
+        if self.max is None or us > self.max:
+            self.max = us
+
+    def percentile(self, q):
+        # Upper bound of the bucket holding the q-th percentile (µs), bounded by the min/max values seen
+        if self.count == 0:
+            return None
+        rank = max(1, int(self.count * q / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return max(self.min, min(self.max, self._bucket_max(index)))
+        return self.max
+
+    def stats(self):
+        # Values in ms
+        if self.count == 0:
+            return dict(count=0)
+        return dict(count=self.count, min=self.min / 1000.0, p50=self.percentile(50) / 1000.0,
+                    p99=self.percentile(99) / 1000.0, max=self.max / 1000.0,
+                    mean=round(self.total / self.count / 1000.0, 3))
+
+
+class LinkLatency(object):
+    """
+        Per command verb write time, time to first byte and round-trip time of a link
+    """
+
+    def __init__(self, nickname=''):
+        self.nickname = nickname
+        self.verbs = dict()
+
+    def record(self, cmd, write_s, ttfb_s, rtt_s):
+        verb = command_verb(cmd)
+        if verb not in self.verbs:
+            if len(self.verbs) >= MAX_VERBS:
+                verb = 'other'
+            self.verbs.setdefault(verb, (LatencyHistogram(), LatencyHistogram(), LatencyHistogram()))
+        write, ttfb, rtt = self.verbs[verb]
+        write.add(write_s)
+        ttfb.add(ttfb_s)
+        rtt.add(rtt_s)
+
+    def reset(self):
+        self.verbs = dict()
+
+    def stats(self):
+        res = dict()
+        for verb, (write, ttfb, rtt) in self.verbs.items():
+            res[verb] = dict(write=write.stats(), ttfb=ttfb.stats(), rtt=rtt.stats())
+        return res
+
+    def json(self):
+        return json.dumps({self.nickname: self.stats()}, indent=1, sort_keys=True)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.json())
+
+    def __str__(self):
+        res = str.format("%-8s %-24s %6s %9s %9s %9s %9s %9s\n" % (self.nickname, 'rtt (ms)', 'count', 'min', 'p50',
+                                                                     'p99', 'max', 'ttfb p50'))
+        for verb, stats in sorted(self.stats().items()):
+            rtt = stats['rtt']
+            res += str.format("%-8s %-24s %6d %9.3f %9.3f %9.3f %9.3f %9.3f\n" %
+                              ('', verb, rtt['count'], rtt['min'], rtt['p50'], rtt['p99'], rtt['max'],
+                               stats['ttfb']['p50']))
+        return res.strip()
+
+
+class LatencyHooks(object):
+    """
+        Latency recording of links (sync and async): _sending() before writing a command, _sent() once written,
+         _received() once its output is read. first_byte is the time its first output byte was received
+    """
+    command = None
+    write_start = None
+    write_end = None
+    first_byte = None
+    _latency = None
+
+    @property
+    def latency(self):
+        # LinkLatency histograms of all commands of this link
+        if self._latency is None:
+            self._latency = LinkLatency(self.nickname)
+        return self._latency
+
+    def _sending(self, cmd):
+        self.command = cmd
+        self.first_byte = None
+        self.write_start = time.time()
+
+    def _sent(self):
+        self.write_end = time.time()
+
+    def _received(self, first_byte=None):
+        if self.command is not None:
+            end = time.time()
+            first_byte = first_byte or self.first_byte or end
+            self.latency.record(self.command, self.write_end - self.write_start, first_byte - self.write_start,
+                                end - self.write_start)
+            self.command = None
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+#
+# Record/replay of link exchanges, to run test scripts (WfxTestDut, WfxTestTarget, WfxPtaTarget) without hardware
+#
+#  Recording:
+#   dut = WfxTestDut('Pi_186', link=Recorder(Ssh('Pi_186', host='10.5.124.186', user='root'), 'pi_186.jsonl'))
+#  Replaying (speed=None: no waiting, 1.0: recorded timings, 10.0: 10 times faster):
+#   dut = WfxTestDut('Pi_186', link=Replay('pi_186.jsonl', speed=None))
+#
+import json
+import time
+import logging
+import collections
+
+from wfx_connection import *
+
+
+class Recorder(AbstractConnection):
+    """
+        Wraps a link, saving each command with its response, exit status and timings to a JSONL file
+    """
+
+    def __init__(self, link, path):
+        self.link = link
+        self.nickname = link.nickname
+        self.conn = link.conn
+        self.exit_status = None
+        # Commands written and not read yet (links can pipeline commands)
+        self.written = collections.deque()
+        self.file = open(path, 'w')
+        self.file.write(json.dumps(dict(link=self.nickname, conn=self.conn)) + '\n')
+
+    def _save(self, cmd, res, start, write_s):
+        self.exit_status = getattr(self.link, 'exit_status', None)
+        self.file.write(json.dumps(dict(cmd=cmd, res=res, exit_status=self.exit_status, write_s=round(write_s, 6),
+                                        rtt_s=round(time.time() - start, 6))) + '\n')
+        self.file.flush()
+
+    def configure(self, *args, **kwargs):
+        self.link.configure(*args, **kwargs)
+
+    def write(self, text):
+        start = time.time()
+        self.link.write(text)
+        self.written.append((text.strip(), start, time.time() - start))
+
+    def read(self):
+        res = self.link.read()
+        if self.written:
+            self._save(*self._pop(res))
+        return res
+
+    def _pop(self, res):
+        cmd, start, write_s = self.written.popleft()
+        return cmd, res, start, write_s
+
+    def run(self, cmd, wait_ms=0):
+        start = time.time()
+        res = self.link.run(cmd, wait_ms)
+        self._save(cmd.strip(), res, start, 0)
+        return res
+
+    def run_many(self, commands):
+        start = time.time()
+        results = self.link.run_many(commands)
+        for cmd, (res, exit_status) in zip(commands, results):
+            self.file.write(json.dumps(dict(cmd=cmd.strip(), res=res, exit_status=exit_status, write_s=0,
+                                            rtt_s=round(time.time() - start, 6))) + '\n')
+        self.file.flush()
+        return results
+
+    def wait_for(self, pattern, timeout=10.0):
+        res = self.link.wait_for(pattern, timeout)
+        if self.written:
+            self._save(*self._pop(res))
+        return res
+
+    @property
+    def latency(self):
+        return self.link.latency
+
+    @property
+    def trace(self):
+        return self.link.trace
+
+    @trace.setter
+    def trace(self, value):
+        self.link.trace = value
+
+    def close(self):
+        self.link.close()
+        self.file.close()
+
+
+class Replay(AbstractConnection):
+    """
+        Link serving the responses saved by a Recorder: each command gets its recorded responses in order,
+         the last one being repeated once they are all used
+    """
+
+    def __init__(self, path, nickname=None, speed=None):
+        self.speed = speed
+        self.responses = dict()
+        self.current = None
+        self.exit_status = None
+        self.write_start = None
+        with open(path) as f:
+            header = json.loads(f.readline())
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses.setdefault(record['cmd'], collections.deque()).append(record)
+        self.nickname = nickname if nickname else header['link']
+        self.conn = 'Replay of ' + header['conn']
+
+    def configure(self, *args, **kwargs):
+        pass
+
+    def _sleep(self, seconds):
+        if self.speed:
+            time.sleep(max(0, seconds / self.speed))
+
+    def write(self, text):
+        self.write_start = time.time()
+        cmd = text.strip()
+        if cmd not in self.responses:
+            logging.warning("%s no recorded response for '%s'" % (self.nickname, cmd))
+            self.current = dict(cmd=cmd, res='', exit_status=None, write_s=0, rtt_s=0)
+        else:
+            records = self.responses[cmd]
+            self.current = records.popleft() if len(records) > 1 else records[0]
+        self._sleep(self.current['write_s'])
+
+    def read(self):
+        if self.current is None:
+            return ''
+        self._sleep(self.current['rtt_s'] - (time.time() - self.write_start) * (self.speed if self.speed else 0))
+        res = self.current['res']
+        self.exit_status = self.current['exit_status']
+        self.current = None
+        return res
+
+    def run(self, cmd, wait_ms=0):
+        # wait_ms is part of the recorded rtt
+        self.write(cmd)
+        return self.read()
+
+    def _read_chunk(self, timeout):
+        if self.current is None:
+            time.sleep(min(timeout, 0.01))
+        return self.read()
+
+    def close(self):
+        pass
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+#
+# Link tracing: links append timestamped records to an in-memory ring buffer, a background thread writes them
+#  to the console (same format as the former print() tracing) or to a JSONL capture file
+#
+#  Reading a capture file: python3 wfx_trace.py capture.jsonl [link_nickname]
+#
+import sys
+import json
+import time
+import atexit
+import threading
+import collections
+
+
+class TraceSink(object):
+    """
+        Process-wide trace buffer. Records are (timestamp, link nickname, link kind, '>' (sent) or '<' (received), text)
+    """
+
+    def __init__(self, max_records=100000, flush_s=0.1):
+        self.records = collections.deque(maxlen=max_records)
+        self.flush_s = flush_s
+        self.path = None
+        self.file = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.writer = None
+        # Records dropped (oldest first) because the buffer was full: since the last flush, and in total
+        self.dropped = 0
+        self.dropped_total = 0
+
+    def record(self, nickname, kind, direction, text):
+        # Hot path: a single append, formatting and output are done by the writer thread
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+            self.dropped_total += 1
+        self.records.append((time.time(), nickname, kind, direction, text))
+        if self.writer is None:
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.writer is None:
+                self.stopped.clear()
+                self.writer = threading.Thread(target=self._write_loop, name='wfx_trace', daemon=True)
+                self.writer.start()
+
+    def _write_loop(self):
+        while not self.stopped.wait(self.flush_s):
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.writer = None
+        self.flush()
+
+    def capture(self, path=None):
+        # Writes the next records to the 'path' JSONL file, or to the console when path is None
+        with self.lock:
+            self._flush()
+            if self.file is not None:
+                self.file.close()
+            self.path = path
+            self.file = open(path, 'a') if path else None
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        lines = []
+        dropped, self.dropped = self.dropped, 0
+        if dropped:
+            # Reported where the gap is: before the oldest records left
+            text = '%d trace records dropped (buffer full)' % dropped
+            if self.file is not None:
+                lines.append(json.dumps(dict(t=round(time.time(), 6), link='trace_sink', kind='!', dir='!', text=text)))
+            else:
+                lines.append('trace_sink !!|  ' + text)
+        while self.records:
+            timestamp, nickname, kind, direction, text = self.records.popleft()
+            if self.file is not None:
+                lines.append(json.dumps(dict(t=round(timestamp, 6), link=nickname, kind=kind, dir=direction,
+                                             text=text)))
+            else:
+                lines.extend(console_lines(nickname, kind, direction, text))
+        if lines:
+            output = self.file if self.file is not None else sys.stdout
+            output.write('\n'.join(lines) + '\n')
+            output.flush()
+
+
+def console_lines(nickname, kind, direction, text):
+    if direction == '>':
+        return [str.format("%-8s %s>>|  " % (nickname, kind)) + line for line in str(text).strip().split('\n')]
+    return [str.format("<<%s %8s|  " % (kind, nickname)) + line for line in str(text).split('\n')]
+
+
+def read_capture(path, nickname=None):
+    # Yields the records of a JSONL capture file as dicts (t, link, kind, dir, text)
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if nickname is None or record['link'] == nickname:
+                    yield record
+
+
+trace_sink = TraceSink()
+atexit.register(trace_sink.flush)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Use: python3 wfx_trace.py capture.jsonl [link_nickname]')
+        sys.exit(1)
+    origin = None
+    for record in read_capture(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None):
+        origin = record['t'] if origin is None else origin
+        for line in console_lines(record['link'], record['kind'], record['dir'], record['text']):
+            print('%10.3f  %s' % (record['t'] - origin, line))
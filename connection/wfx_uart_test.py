@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+#
+# Uart responses over a pseudo-terminal, against an agent console echoing each command twice: once as typed,
+#  then again after its prompt (as readline does when a command is typed while the previous one still runs)
+#
+#  python3 -m unittest wfx_uart_test    (needs pyserial)
+#
+import os
+import pty
+import tty
+import select
+import subprocess
+import threading
+import unittest
+
+from wfx_connection import *
+
+
+class EchoingConsole(object):
+    # Agent console on the master side of a pty: the Uart opens the slave side
+
+    def __init__(self, prompt='pi# '):
+        self.prompt = prompt
+        # The slave side stays open: the master side fails once no one has it open
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.shell = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT)
+        self.shell.stdin.write(b'wfx_test_agent() { echo "wfx_test_agent 1.0"; }\n')
+        self.shell.stdin.flush()
+        self.running = True
+        self.threads = [threading.Thread(target=self._commands), threading.Thread(target=self._output)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _write(self, data):
+        os.write(self.master, data.replace(b'\n', b'\r\n'))
+
+    def _commands(self):
+        line = b''
+        while self.running:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            try:
+                line += os.read(self.master, 4096)
+            except OSError:
+                break
+            while b'\n' in line:
+                cmd, line = line.split(b'\n', 1)
+                self._write(cmd + b'\n' + bytes(self.prompt, 'utf-8') + cmd + b'\n')
+                self.shell.stdin.write(cmd + b'\n')
+                self.shell.stdin.flush()
+
+    def _output(self):
+        for data in iter(lambda: os.read(self.shell.stdout.fileno(), 4096), b''):
+            self._write(data)
+
+    def close(self):
+        self.running = False
+        self.shell.kill()
+        self.shell.wait()
+        for thread in self.threads:
+            thread.join()
+        self.shell.stdin.close()
+        self.shell.stdout.close()
+        os.close(self.slave)
+        os.close(self.master)
+
+
+@unittest.skipIf(load_serial() is None, "'serial' is not installed")
+class UartEchoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.console = EchoingConsole()
+        self.uart = Uart('uart', port=self.console.port, framed=True)
+
+    def tearDown(self):
+        self.uart.close()
+        self.console.close()
+
+    def test_run(self):
+        self.assertEqual(self.uart.run('echo a; echo b'), 'a\nb')
+        self.assertEqual(self.uart.exit_status, 0)
+
+    def test_run_until(self):
+        res = self.uart.run_until('echo x; sleep 0.3; echo READY; echo tail', 'READY', 5.0)
+        self.assertEqual(res, 'x\nREADY\n')
+        self.assertEqual(self.uart.read(), 'tail')
+        self.assertEqual(self.uart.run('echo next'), 'next')
+
+    def test_wait_for_echoed_pattern(self):
+        # The pattern is part of the command: only its output may match
+        self.uart.write('sleep 0.3; echo done')
+        self.assertEqual(self.uart.wait_for('done', 5.0), 'done\n')
+        self.assertEqual(self.uart.read(), '')
+        self.assertEqual(self.uart.exit_status, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
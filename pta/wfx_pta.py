@@ -56,28 +56,36 @@ class WfxPtaTarget(object):
         if 'host' in kwargs or nickname or self.connect:
             sys.path.append('../connection')
             import wfx_connection as wfx_cnx #from wfx_connection import *
+        if 'link' in kwargs:
+            # Any link object (such as a wfx_replay Recorder or Replay), used as is
+            self.link = kwargs['link']
 
-        if 'host' in kwargs:
+        if not self.link and 'host' in kwargs:
             host = kwargs['host']
             port = kwargs['port'] if 'port' in kwargs else 22
             user = kwargs['user'] if 'user' in kwargs else 'root'
             print('%s: Configuring a SSH connection to host %s for user %s (port %d)' % (nickname, host, user, port))
             password = kwargs['password'] if 'password' in kwargs else None
-            self.link = wfx_cnx.Ssh(nickname, host=host, user=user, port=port, password=password)
+            persistent = kwargs['persistent'] if 'persistent' in kwargs else False
+            self.link = wfx_cnx.Ssh(nickname, host=host, user=user, port=port, password=password,
+                                    persistent=persistent)
 
         if not self.link:
             if 'port' in kwargs:
                 port = kwargs['port']
                 print('%s: Configuring a UART connection using %s' % (nickname, port))
-                self.link = wfx_cnx.Uart(nickname, port=port)
+                framed = kwargs['framed'] if 'framed' in kwargs else None
+                reader = kwargs['reader'] if 'reader' in kwargs else False
+                self.link = wfx_cnx.Uart(nickname, port=port, framed=framed, reader=reader)
                 if self.link is None:
                     if port in wfx_cnx.uarts():
                         raise Exception(port + ' is detected but is not available. Check for other applications using ' + port)
 
         if not self.link:
-            if not kwargs:
+            if not [key for key in kwargs if key != 'persistent']:
                 print('%s: Configuring a Direct connection' % nickname)
-                self.link = wfx_cnx.Direct(nickname)
+                persistent = kwargs['persistent'] if 'persistent' in kwargs else False
+                self.link = wfx_cnx.Direct(nickname, persistent=persistent)
 
     def write(self, text):
         if self.link is not None:
@@ -95,6 +103,23 @@ class WfxPtaTarget(object):
         time.sleep(wait_ms/1000.0)
         return self.read()
 
+    @property
+    def latency(self):
+        # Per command verb latency histograms of the link (see wfx_latency.py)
+        return self.link.latency if self.link is not None else None
+
+    def wait_for(self, pattern, timeout=10.0):
+        # Returns the output as soon as it matches pattern (regex or predicate), raises LinkTimeout otherwise
+        if self.link is None:
+            sys.path.append('../connection')
+            import wfx_connection as wfx_cnx
+            raise wfx_cnx.LinkTimeout(self.nickname, pattern, 0, '')
+        return self.link.wait_for(pattern, timeout)
+
+    def run_until(self, cmd, pattern, timeout=10.0):
+        self.write(cmd)
+        return self.wait_for(pattern, timeout)
+
     def pta_help(self):
         pta = WfxPtaData()
         pta.set_args('--help')
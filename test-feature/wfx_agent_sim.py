@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""wfx_agent_sim.py
+    In-process simulation of a DUT running the linux wfx_test_agent, to run (and load test) WfxTestDut without HW
+
+    Use case:
+        dut = WfxTestDut('sim', link=SimAgent('sim', latency_ms=5, frame_rate=2000))
+        dut.test_ind_period(100)
+        dut.rx_start()
+        dut.rx_receive(frames=10000)
+
+    All wfx_test_agent options are supported. 'send_pds' data is parsed to follow TEST_MODE (rx or not) and TEST_IND,
+     'read_rx_stats' returning the same statistics as the driver: one table per TEST_IND period, while in rx mode.
+"""
+
+import re
+import sys
+import time
+import random
+import shlex
+sys.path.append('../connection')
+
+from wfx_connection import *
+
+rx_rates = ['1M', '2M', '5.5M', '11M', '6M', '9M', '12M', '18M', '24M', '36M', '48M', '54M',
+            'MCS0', 'MCS1', 'MCS2', 'MCS3', 'MCS4', 'MCS5', 'MCS6', 'MCS7']
+
+# PDS keys (see definitions.in) used by the simulation
+TEST_FEATURE_CFG = 'i'
+TEST_MODE = 'b'
+TEST_IND = 'f'
+TEST_MODE_RX = 2
+
+
+def parse_pds(text):
+    # Compressed PDS string ('{i:{a:B,b:2,f:3E8}}') to nested dicts/lists of (hexadecimal) strings
+    tokens = re.findall(r'[{}\[\]:,]|[^{}\[\]:,]+', text.strip())
+    pos = 0
+
+    def value():
+        nonlocal pos
+        token = tokens[pos]
+        pos += 1
+        if token == '{':
+            res = dict()
+            while tokens[pos] != '}':
+                key = tokens[pos]
+                pos += 2
+                res[key] = value()
+                if tokens[pos] == ',':
+                    pos += 1
+            pos += 1
+            return res
+        if token == '[':
+            res = []
+            while tokens[pos] != ']':
+                res.append(value())
+                if tokens[pos] == ',':
+                    pos += 1
+            pos += 1
+            return res
+        return token
+
+    return value() if tokens else dict()
+
+
+class SimAgent(AbstractConnection):
+    """
+        Link answering wfx_test_agent commands like a linux DUT, after latency_ms.
+        In rx mode, frame_rate frames/s are received (spread over 'rates'), with a PER around per_x10e4
+    """
+
+    def __init__(self, nickname='sim', fw_version='2.2.1', driver_version='2.0.3', agent_version='1.1.0',
+                 latency_ms=0, frame_rate=1000, per_x10e4=100, rssi=-60, frame_size=1500, rates=('54M', 'MCS7'),
+                 seed=0):
+        self.nickname = nickname
+        self.conn = 'Simulated agent (FW' + fw_version + ')'
+        self.versions = dict(read_fw_version=fw_version, read_driver_version=driver_version,
+                             read_agent_version=agent_version)
+        self.latency_ms = latency_ms
+        self.frame_rate = frame_rate
+        self.per_x10e4 = per_x10e4
+        self.rssi = rssi
+        self.frame_size = frame_size
+        self.rates = list(rates)
+        self.seed = seed
+        # Driver timestamps are counted from the DUT boot
+        self.boot = time.time() - 60
+        self.send_pds = ''
+        self.messages = []
+        self.test_ind_ms = 1000
+        self.rx_since = None
+        self.rx_until = None
+        self.response = None
+        self.ready = 0
+        self.exit_status = None
+
+    def configure(self, *args, **kwargs):
+        pass
+
+    def _timestamp_us(self, t):
+        return int((t - self.boot) * 1000000) % pow(2, 31)
+
+    def _write_test_data(self, data):
+        self.send_pds = data
+        test_cfg = parse_pds(data).get(TEST_FEATURE_CFG, dict())
+        if TEST_IND in test_cfg:
+            self.test_ind_ms = int(test_cfg[TEST_IND], 16)
+        if TEST_MODE in test_cfg:
+            rx = int(test_cfg[TEST_MODE], 16) == TEST_MODE_RX
+            now = time.time()
+            if rx and (self.rx_since is None or self.rx_until is not None):
+                self.rx_since, self.rx_until = now, None
+            elif not rx and self.rx_since is not None and self.rx_until is None:
+                self.rx_until = now
+        return "'" + data + "' sent to /sys/kernel/debug/ieee80211/phy0/wfx/send_pds"
+
+    def _rx_stats(self):
+        # Statistics of the last complete TEST_IND period, as the driver reports them
+        if self.rx_since is None:
+            return self._rx_table(0, 0, [])
+        period_s = self.test_ind_ms / 1000.0
+        end = time.time() if self.rx_until is None else self.rx_until
+        index = int((end - self.rx_since) / period_s)
+        if index == 0:
+            return self._rx_table(0, 0, [])
+        rand = random.Random(self.seed * 1000003 + index)
+        frames = int(self.frame_rate * period_s)
+        rows = []
+        for n, rate in enumerate(self.rates):
+            rate_frames = frames // len(self.rates) + (1 if n < frames % len(self.rates) else 0)
+            per = max(0, int(rand.gauss(self.per_x10e4, self.per_x10e4 / 5.0))) if rate_frames else 0
+            rssi = self.rssi + rand.randint(-2, 2)
+            rows.append((rate, rate_frames, per, rssi, rssi + 95, rand.randint(-20, 20)))
+        errors = sum(row[1] * row[2] / 10000.0 for row in rows)
+        per = int(errors * 10000 / frames) if frames else 0
+        throughput = int((frames - errors) * self.frame_size * 8 / 1000 / period_s)
+        return self._rx_table(self._timestamp_us(self.rx_since + index * period_s), frames, rows, per, throughput)
+
+    @staticmethod
+    def _rx_table(timestamp, frames, rows, per=0, throughput=0):
+        res = 'Timestamp: %dus\n' % timestamp
+        res += 'Low power clock: frequency 32759Hz, external yes\n'
+        res += 'Num. of frames: %d, PER (x10e4): %d, Throughput: %dKbps/s\n' % (frames, per, throughput)
+        res += '.     Num. of      PER     RSSI      SNR      CFO\n'
+        res += 'rate   frames  (x10e4)    (dBm)     (dB)    (kHz)\n'
+        values = dict((row[0], row[1:]) for row in rows)
+        for rate in rx_rates:
+            res += '%5s %8d %8d %8d %8d %8d\n' % ((rate,) + values.get(rate, (0, 0, 0, 0, 0)))
+        return res.strip()
+
+    def execute(self, cmd):
+        # Returns (stdout, exit status) of a shell command line. Only wfx_test_agent commands are known
+        try:
+            args = shlex.split(cmd)
+        except ValueError:
+            args = cmd.split()
+        if not args or args[0] != 'wfx_test_agent':
+            return 'ERROR: sh: 1: ' + (args[0] if args else '') + ': not found', 127
+        option = args[1] if len(args) > 1 else ''
+        if option in self.versions:
+            return self.versions[option], 0
+        if option == 'write_test_data' and len(args) > 2:
+            return self._write_test_data(args[2]), 0
+        if option == 'read_rx_stats':
+            return self._rx_stats(), 0
+        if option == 'log_message':
+            self.messages.append(args[2] if len(args) > 2 else '')
+            return 'Done', 0
+        return 'ERROR: unknown wfx_test_agent option ' + option, 1
+
+    def write(self, text):
+        if self.trace:
+            trace_sink.record(self.nickname, 'D', '>', text)
+        self._sending(text)
+        self.response, self.exit_status = self.execute(str(text, 'utf-8') if isinstance(text, bytes) else text)
+        self.ready = time.time() + self.latency_ms / 1000.0
+        self._sent()
+
+    def read(self):
+        if self.response is None:
+            return ''
+        time.sleep(max(0, self.ready - time.time()))
+        res, self.response = self.response, None
+        self._received()
+        if self.trace:
+            trace_sink.record(self.nickname, 'D', '<', res)
+        return res
+
+    def run(self, cmd, wait_ms=0):
+        self.write(cmd)
+        time.sleep(wait_ms/1000.0)
+        return self.read()
+
+    def _read_chunk(self, timeout):
+        if self.response is None:
+            time.sleep(min(timeout, 0.01))
+        return self.read()
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    from wfx_test_dut import WfxTestDut
+
+    dut = WfxTestDut('sim', link=SimAgent('sim', latency_ms=2, frame_rate=5000))
+    print(dut.test_conditions())
+    dut.test_ind_period(100)
+    dut.rx_start()
+    start = time.time()
+    print(dut.rx_receive(frames=5000))
+    print('rx_receive of 5000 frames in %.2f s' % (time.time() - start))
+    print(dut.link.latency)
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+#
+# PdsTree micro-benchmarks: time per call of the PdsTree operations used by each test script setter
+#
+#  Use: python3 wfx_pds_bench.py [calls]
+#
+import io
+import sys
+import time
+import contextlib
+
+from wfx_pds_tree import *
+
+# Values within the VALUES of each key (others are not set)
+settings = [('NB_FRAME', '100'), ('TEST_MODE', 'rx'), ('RATE', 'N_MCS7'), ('TEST_IND', '1000'),
+            ('FRAME_SIZE_BYTE', '3000'), ('RF_PORT', 'RF_PORT_1'), ('FREQ1', '5'), ('TEST_CHANNEL_FREQ', '6')]
+keys = [key for key, value in settings]
+
+
+def filled_tree(fw_version='2.2.1'):
+    pds = PdsTree()
+    # fill_tree() prints messages about parameters not supported by fw_version
+    with contextlib.redirect_stdout(io.StringIO()):
+        pds.fill_tree(fw_version)
+    check_pds_warning()
+    return pds
+
+
+def bench_set(pds, calls):
+    for n in range(calls):
+        key, value = settings[n % len(settings)]
+        pds.set(key, value)
+
+
+def bench_get(pds, calls):
+    for n in range(calls):
+        pds.get(keys[n % len(keys)])
+
+
+def bench_sub_tree(pds, calls):
+    # Sections selected by each setter call
+    for n in range(calls):
+        pds.sub_tree([keys[n % len(keys)]])
+
+
+def bench_pretty(pds, calls):
+    # Whole tree rendering
+    for n in range(calls):
+        pds.pretty()
+
+
+def bench_send(pds, calls):
+    # Rendering of the sections selected by each setter call
+    for n in range(calls):
+        pds.sub_tree([keys[n % len(keys)]]).pretty()
+
+
+def bench_fill(pds, calls):
+    # A new tree per DUT
+    with contextlib.redirect_stdout(io.StringIO()):
+        for n in range(calls):
+            PdsTree().fill_tree(pds.current_fw_version)
+    check_pds_warning()
+
+
+cases = [
+    ('set', bench_set),
+    ('get', bench_get),
+    ('sub_tree', bench_sub_tree),
+    ('pretty', bench_pretty),
+    ('sub_tree+pretty', bench_send),
+    ('fill_tree', bench_fill),
+]
+
+
+def measure(bench, calls):
+    # Returns the time per call (s)
+    pds = filled_tree()
+    start = time.perf_counter()
+    bench(pds, calls)
+    return (time.perf_counter() - start) / calls
+
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('%-16s %12s %10s' % ('', 'calls', 'us/call'))
+    for name, bench in cases:
+        print('%-16s %12d %10.2f' % (name, calls, measure(bench, calls) * 1000000))
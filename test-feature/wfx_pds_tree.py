@@ -17,7 +17,8 @@
 
 """
 
-from copy import deepcopy
+import re
+from types import MappingProxyType
 from distutils.version import StrictVersion
 
 wfx_pds = [
@@ -56,14 +57,159 @@ wfx_pds = [
 ]
 
 pds_order = []
+# Position of each pds_order name
+pds_order_index = dict()
 pds_warning = ""
 
 
+class PdsParameter(object):
+    """
+        One wfx_pds item, with its path levels and parsed VALUES: (min, max) 'limits' for ranges such as
+         '[-128; 127]', 'choices' for lists of names. Both are None when VALUES is not explicit ('TBD')
+    """
+    __slots__ = ('key', 'version', 'default', 'path', 'levels', 'values', 'doc', 'limits', 'choices')
+
+    def __init__(self, key, version, default, path, values, doc):
+        self.key = str(key)
+        self.version = str(version)
+        self.default = str(default)
+        self.path = str(path)
+        self.levels = tuple(self.path.split('.'))
+        self.values = values
+        self.doc = doc
+        self.limits = None
+        self.choices = None
+        limits = re.match(r'^\[\s*(-?\d+)\s*[;,]\s*(-?\d+)\s*\]', values)
+        if limits:
+            self.limits = (int(limits.group(1)), int(limits.group(2)))
+        elif not values.startswith('[') and 'TBD' not in values and values != 'unknown range':
+            self.choices = tuple(choice.split('(')[0].strip() for choice in values.split(','))
+
+    def check(self, value):
+        # Message if value (an integer or an array of integers for limits) is not in VALUES, None if it is
+        if self.limits is not None:
+            try:
+                valid = all(self.limits[0] <= int(i) <= self.limits[1] for i in value.strip().strip('[]').split(','))
+            except ValueError:
+                valid = False
+            if not valid:
+                return "value '" + value + "' of '" + self.key + "' not in " + self.values + " (not set)"
+        elif self.choices is not None and value not in self.choices:
+            return "value '" + value + "' of '" + self.key + "' not in " + str(list(self.choices)) + " (not set)"
+        return None
+
+
+class PdsSchema(object):
+    """
+        wfx_pds compiled for a FW version (see pds_schema()): parameters supported by this version (in wfx_pds order,
+         with their parsed VALUES), 'skipped' messages for the others, and a template tree with the default values.
+        Shared by all trees for this FW version: template and by_key are read-only mappings
+    """
+    __slots__ = ('fw_version', 'parameters', 'keys', 'skipped', 'order', 'template', 'by_key')
+
+    def __init__(self, pds_structure, fw_version):
+        self.fw_version = fw_version
+        fw = StrictVersion(fw_version)
+        parameters = []
+        skipped = []
+        order = dict()
+        template = dict()
+        # key -> (wfx_pds position, parameter), supported or not
+        by_key = dict()
+        for position, item in enumerate(pds_structure):
+            parameter = PdsParameter(*item)
+            by_key[parameter.key] = (position, parameter)
+            if StrictVersion(parameter.version) > fw:
+                skipped.append(parameter)
+                continue
+            parameters.append(parameter)
+            node = template
+            for level in parameter.levels:
+                node = node.setdefault(level, dict())
+                order.setdefault(level, None)
+            node[parameter.key] = parameter.default
+            order.setdefault(parameter.key, None)
+        self.parameters = tuple(parameters)
+        self.keys = tuple(parameter.key for parameter in parameters)
+        self.skipped = tuple(skipped)
+        # Section and key names, in order of appearance
+        self.order = tuple(order)
+        self.template = _read_only(template)
+        self.by_key = MappingProxyType(by_key)
+
+
+# Compiled schemas, by (pds_structure id, FW version). Cleared when parameters are added (add_tmp_param())
+pds_schemas = dict()
+
+
+def pds_schema(pds_structure, fw_version):
+    schema_key = (id(pds_structure), fw_version)
+    if schema_key not in pds_schemas:
+        pds_schemas[schema_key] = PdsSchema(pds_structure, fw_version)
+    return pds_schemas[schema_key]
+
+
+def add_pds_order(names):
+    for name in names:
+        if name not in pds_order_index:
+            pds_order_index[name] = len(pds_order)
+            pds_order.append(name)
+            pds_node_orders.clear()
+
+
+# Rendering order (pds_order) of the names of a node, by names tuple. Cleared when pds_order changes
+pds_node_orders = dict()
+
+
+def _node_order(node):
+    names = tuple(node)
+    order = pds_node_orders.get(names)
+    if order is None:
+        order = sorted((name for name in names if name in pds_order_index), key=pds_order_index.__getitem__)
+        pds_node_orders[names] = order
+    return order
+
+
+def _pretty_lines(node, indent, lines):
+    tabs = '\t' * indent
+    for k in _node_order(node):
+        v = node[k]
+        if isinstance(v, dict):
+            if '[]' in k:
+                lines.append(tabs + k.replace('[', '').replace(']', '') + " : [ {\n")
+            else:
+                lines.append(tabs + str(k) + " : {\n")
+            _pretty_lines(v, indent + 1, lines)
+            if '[]' in k:
+                lines.append(tabs + "} ],\n")
+            else:
+                lines.append(tabs + "},\n")
+        elif str(v) == "":
+            lines.append(tabs + str(k) + ' :' + ' ' * max(1, 32 - len(k)) + '{ }' + ",\n")
+        else:
+            lines.append(tabs + str(k) + ' :' + ' ' * max(1, 32 - len(k)) + str(v) + ",\n")
+
+
+def _read_only(node):
+    return MappingProxyType(dict((key, _read_only(value) if isinstance(value, dict) else value)
+                                 for key, value in node.items()))
+
+
+def _merge_nodes(node, template):
+    # Copies the template nodes (read-only mappings) and default values into node
+    for key, value in template.items():
+        if isinstance(value, MappingProxyType):
+            _merge_nodes(node.setdefault(key, dict()), value)
+        else:
+            node[key] = value
+
+
 class PdsTree(dict):
     """
         Returns a ```PdsTree``` object with the given name
     """
     pds_keys = []
+    pds_key_set = set()
 
     def __init__(self):
         dict.__init__(self)
@@ -71,6 +217,19 @@ class PdsTree(dict):
         self.pds_structure = wfx_pds
         self.max_fw_version = "2.2.2"
         self.current_fw_version = self.max_fw_version
+        # key -> (parent node dict, None) for keys supported by current_fw_version, (None, warning) otherwise
+        self.key_index = dict()
+        # key -> section (top-level node) holding it
+        self.key_sections = dict()
+        # key -> PdsParameter (parsed VALUES) of the keys filled from the schema
+        self.key_parameters = dict()
+        # (rendering, payload bytes) of each section last sent to the device (see mark_sent()), sections set()
+        #  since then
+        self.sent_sections = dict()
+        self.dirty_sections = set()
+        # Compressed test data bytes sent, and left out by unsent() because already sent
+        self.sent_bytes = 0
+        self.skipped_bytes = 0
 
     def set_current_fw_version(self, version):
         self.current_fw_version = version
@@ -79,31 +238,44 @@ class PdsTree(dict):
         print(str(self).replace('\'', ''))
 
     def fill_tree(self, version, trace=0):
+        # The schema of a FW version is compiled once, then shared by all trees for this version
         self.set_current_fw_version(version)
+        schema = pds_schema(self.pds_structure, self.current_fw_version)
         msg = ""
-        for item in self.pds_structure:
-            key, version, default, path, values, doc = item
-            if StrictVersion(version) > StrictVersion(self.current_fw_version):
-                msg += "  Info: '" + key + "' cannot be supported with FW" + self.current_fw_version + \
-                       ", it has been added in FW" + version + " (skipped)\n"
-                print(msg)
-            else:
-                self._add_node(str(path), str(key), str(default))
-                if trace:
-                    self.pretty()
-                    print("----------------")
-                levels = str(path).split('.')
-                for level in levels:
-                    if level not in pds_order:
-                        pds_order.append(level)
-                if key not in self.pds_keys:
-                    pds_order.append(key)
-                    self.pds_keys.append(key)
+        for parameter in schema.skipped:
+            msg += "  Info: '" + parameter.key + "' cannot be supported with FW" + self.current_fw_version + \
+                   ", it has been added in FW" + parameter.version + " (skipped)\n"
+            print(msg)
+            self.key_index[parameter.key] = (None, "Warning: '" + parameter.key + "' cannot be supported with FW" +
+                                             self.current_fw_version + ", it has been added in FW" +
+                                             parameter.version + " (skipped)\n")
+        _merge_nodes(self, schema.template)
+        for parameter in schema.parameters:
+            node = self
+            for level in parameter.levels:
+                node = node[level]
+            self.key_index[parameter.key] = (node, None)
+            self.key_sections[parameter.key] = parameter.levels[0]
+            self.key_parameters[parameter.key] = parameter
+        add_pds_order(schema.order)
+        self._add_keys(schema.keys)
+        if trace:
+            # The tree is filled at once from the schema: traced once filled
+            print(self.pretty())
+            print("----------------")
+        # Default values, whatever the device has
+        self.forget_sent()
         if msg:
             add_pds_warning(msg)
             print("fill_tree has messages: \n" + msg)
         return msg
 
+    def _add_keys(self, keys):
+        for key in keys:
+            if key not in self.pds_key_set:
+                self.pds_key_set.add(key)
+                self.pds_keys.append(key)
+
     def add_tmp_param(self, version, path, key, default, trace=0):
         msg = ""
         if StrictVersion(version) > StrictVersion(self.current_fw_version):
@@ -112,99 +284,134 @@ class PdsTree(dict):
             add_pds_warning(msg)
             print(msg)
         else:
-            self._add_node(str(path), str(key), str(default))
-            levels = str(path).split('.')
-            for level in levels:
-                if level not in pds_order:
-                    pds_order.append(level)
-            if key not in self.pds_keys:
-                pds_order.append(key)
-                self.pds_keys.append(key)
+            self.key_index[str(key)] = (self._add_node(str(path), str(key), str(default)), None)
+            self.key_sections[str(key)] = str(path).split('.')[0]
+            self.dirty_sections.add(self.key_sections[str(key)])
+            add_pds_order(str(path).split('.') + [key])
+            self._add_keys([key])
             self.pds_structure.append((str(key), str(version), str(default), str(path), "unknown range",
                                        "Temporary parameter, lost after closing"))
+            # Compiled schemas don't have this parameter
+            pds_schemas.clear()
             if trace:
                 self.pretty()
                 print("---- tmp -------")
             return self.pretty()
 
     def sub_tree(self, keys_to_keep=None):
-        pds_subtree = deepcopy(self)
+        # Selection of the sections holding keys_to_keep. Sections are shared with self (not copied): read-only use
         if len(keys_to_keep) == 0:
             return self
-        sections_to_keep = []
-        sections_to_delete = []
-        for item in self.pds_structure:
-            key, version, default, path, values, doc = item
-            section_root = path.split('.')[0]
-            if key in keys_to_keep and section_root not in keys_to_keep:
-                if StrictVersion(version) > StrictVersion(self.current_fw_version):
-                    msg = "  Info: '" + key + "' cannot be supported with FW" + self.current_fw_version + \
-                           ", it has been added in FW" + version + " (skipped)\n"
+        schema = pds_schema(self.pds_structure, self.current_fw_version)
+        sections_to_keep = set()
+        for position, parameter in sorted(schema.by_key[key] for key in set(keys_to_keep) if key in schema.by_key):
+            section_root = parameter.levels[0]
+            if section_root not in keys_to_keep:
+                if StrictVersion(parameter.version) > StrictVersion(self.current_fw_version):
+                    msg = "  Info: '" + parameter.key + "' cannot be supported with FW" + self.current_fw_version + \
+                           ", it has been added in FW" + parameter.version + " (skipped)\n"
                     print(msg)
                     add_pds_warning(msg)
                 else:
-                    sections_to_keep.append(section_root)
-        for key in pds_subtree.keys():
-            if key not in sections_to_keep:
-                sections_to_delete.append(key)
-        for key in sections_to_delete:
-            del pds_subtree[key]
-        return pds_subtree
+                    sections_to_keep.add(section_root)
+        return self._view([section for section in self if section in sections_to_keep])
+
+    def _view(self, sections):
+        # PdsTree sharing sections (and the key index) with self
+        pds_view = PdsTree()
+        pds_view.pds_structure = self.pds_structure
+        pds_view.current_fw_version = self.current_fw_version
+        pds_view.key_index = self.key_index
+        pds_view.key_sections = self.key_sections
+        pds_view.key_parameters = self.key_parameters
+        for section in sections:
+            pds_view[section] = self[section]
+        return pds_view
 
     def pretty(self, indent=0):
-        result = ""
-        items_to_print = []
-        for key, v in self.items():
-            items_to_print.append(key)
-        for section in pds_order:
-            for k, v in self.items():
-                if k == section:
-                    if isinstance(v, dict):
-                        if '[]' in k:
-                            result += '\t' * indent + k.replace('[', '').replace(']', '') + " : [ {\n"
-                        else:
-                            result += '\t' * indent + str(k) + " : {\n"
-                        result += PdsTree.pretty(v, indent + 1)
-                        if '[]' in k:
-                            result += '\t' * indent + "} ],\n"
-                        else:
-                            result += '\t' * indent + "},\n"
-                    else:
-                        if str(v) == "":
-                            result += '\t' * indent + str(k) + ' :' + ' ' * max(1, 32 - len(k)) + '{ }' + ",\n"
-                        else:
-                            result += '\t' * indent + str(k) + ' :' + ' ' * max(1, 32 - len(k)) + str(v) + ",\n"
-        return result
+        # Items are rendered in pds_order, items not in pds_order are skipped
+        lines = []
+        _pretty_lines(self, indent, lines)
+        return ''.join(lines)
+
+    def _section_text(self, section):
+        lines = []
+        _pretty_lines({section: self[section]}, 0, lines)
+        return ''.join(lines)
+
+    def sections(self):
+        # [(section, rendering)] in pds_order: pretty() is the concatenation of the renderings
+        return [(section, self._section_text(section)) for section in _node_order(self)]
+
+    def _section_changed(self, section):
+        if section not in self.sent_sections:
+            return True
+        if section not in self.dirty_sections:
+            return False
+        if self._section_text(section) != self.sent_sections[section][0]:
+            return True
+        # Same values as sent
+        self.dirty_sections.discard(section)
+        return False
+
+    def unsent(self, pds_subtree):
+        # pds_subtree without the sections identical to the ones last sent (see mark_sent()), None if all are
+        changed = [section for section in pds_subtree if self._section_changed(section)]
+        if len(changed) == len(pds_subtree):
+            return pds_subtree
+        for section in pds_subtree:
+            if section not in changed:
+                self.skipped_bytes += self.sent_sections[section][1]
+        if not changed:
+            return None
+        return self._view(changed)
+
+    def mark_sent(self, sections, payload_bytes):
+        # Records the renderings of sections (see sections()) as sent to the device, in a payload_bytes payload.
+        #  Sections stay dirty: they may have been set() since they were rendered
+        total = sum(len(text) for section, text in sections)
+        for section, text in sections:
+            # Share of the payload, counted in skipped_bytes when the section isn't sent again
+            self.sent_sections[section] = (text, payload_bytes * len(text) // total if total else 0)
+        self.sent_bytes += payload_bytes
+
+    def forget_sent(self):
+        # The device test data is unknown (such as after a reset): all sections will be sent again
+        self.sent_sections.clear()
+        self.dirty_sections.clear()
 
     def set(self, key, value):
-        if key not in self.pds_keys:
-            msg = "key '" + key + "' not in pds_structure. Possible keys are " + str(self.pds_keys)
-            add_pds_warning(msg)
-            return msg
-        for item in self.pds_structure:
-            k, version, default, path, values, doc = item
-            if k == key:
-                if StrictVersion(version) > StrictVersion(self.current_fw_version):
-                    return "Warning: '" + key + "' cannot be supported with FW" + self.current_fw_version + \
-                           ", it has been added in FW" + version + " (skipped)\n"
-                return self._set_node_value(path, key, value)
-        return "Error setting " + key
+        node, warning = self.key_index.get(key, (None, None))
+        if node is not None:
+            parameter = self.key_parameters.get(key)
+            msg = parameter.check(value) if parameter is not None else None
+            if msg is not None:
+                add_pds_warning(msg)
+                return msg
+            if node[key] != value:
+                self.dirty_sections.add(self.key_sections[key])
+            node[key] = value
+            return str(value)
+        if warning is not None and key in self.pds_key_set:
+            # Known by the tree of a more recent FW
+            return warning
+        msg = "key '" + key + "' not in pds_structure. Possible keys are " + str(self.pds_keys)
+        add_pds_warning(msg)
+        return msg
 
     def get(self, key):
-        if key not in self.pds_keys:
-            msg = "key '" + key + "' not in pds_structure. Possible keys are " + str(self.pds_keys)
-            add_pds_warning(msg)
-            return msg
-        for item in self.pds_structure:
-            k, version, default, path, values, doc = item
-            if k == key:
-                if StrictVersion(version) > StrictVersion(self.current_fw_version):
-                    return "Warning: '" + key + "' cannot be supported with FW" + self.current_fw_version + \
-                           ", it has been added in FW" + version + " (skipped)\n"
-                return self._get_node_value(path, key)
-        return "Error checking " + key
+        node, warning = self.key_index.get(key, (None, None))
+        if node is not None:
+            return str(node[key])
+        if warning is not None and key in self.pds_key_set:
+            # Known by the tree of a more recent FW
+            return warning
+        msg = "key '" + key + "' not in pds_structure. Possible keys are " + str(self.pds_keys)
+        add_pds_warning(msg)
+        return msg
 
     def _add_node(self, path, key, default):
+        # Returns the node holding key
         levels = str(path).split('.')
         next_path = ".".join(levels[1:])
         if levels[0] not in self:
@@ -212,29 +419,10 @@ class PdsTree(dict):
         else:
             new_node = self[levels[0]]
         if len(next_path) > 0:
-            PdsTree._add_node(new_node, str(next_path), str(key), str(default))
+            return PdsTree._add_node(new_node, str(next_path), str(key), str(default))
         else:
             new_node[key] = default
-            return
-
-    def _set_node_value(self, path, key, value):
-        levels = str(path).split('.')
-        next_path = ".".join(levels[1:])
-        current_node = self[levels[0]]
-        if len(next_path) > 0:
-            return PdsTree._set_node_value(current_node, next_path, key, value)
-        else:
-            current_node[key] = value
-            return str(value)
-
-    def _get_node_value(self, path, key):
-        levels = str(path).split('.')
-        next_path = ".".join(levels[1:])
-        current_node = self[levels[0]]
-        if len(next_path) > 0:
-            return PdsTree._get_node_value(current_node, next_path, key)
-        else:
-            return str(current_node[key])
+            return new_node
 
 
 def add_pds_warning(msg):
@@ -13,6 +13,26 @@ class WfxTestDut(WfxTestTarget):
     def __init__(self, nickname, **kwargs):
         critical_message = ''
         super().__init__(nickname, **kwargs)
+        self._init_dut()
+        # Agent and options checks in a single round trip
+        options = self.useful_options + self.required_options
+        results = self.run_many(['wfx_test_agent read_agent_version'] + ['wfx_test_agent ' + o for o in options])
+        self._check_agent(results[0][0])
+        results = [agent_result for agent_result, exit_status in results[1:]]
+
+        for option, agent_result in zip(self.useful_options, results):
+            print('wfx_test_agent ' + option + '  agent_result ' + agent_result)
+            self._check_option(option, agent_result)
+        if self.required_options:
+            print(str(len(self.required_options)) + ' required_options: ' + str(self.required_options))
+            for option, agent_result in zip(self.required_options, results[len(self.useful_options):]):
+                print('wfx_test_agent ' + option + '  agent_result ' + agent_result)
+                critical_message += self._check_option(option, agent_result, critical=True)
+
+        if critical_message != '':
+            raise Exception("%s:\n   %s" % (self.nickname, critical_message))
+
+    def _init_dut(self):
         self.rx_res = None
         self.rx_avg = None
         self.rx_cnt = None
@@ -24,36 +44,25 @@ class WfxTestDut(WfxTestTarget):
         self.rx_averaging = ['RSSI', 'SNR', 'CFO']
         self.rx_globals = ['frames', 'errors', 'PER', 'Throughput', 'deltaT', 'loops', 'start_us', 'last_us']
         self.rx_job = None
-        self.__rx_clear()
-        agent_reply = self.run('wfx_test_agent read_agent_version')
+        self._rx_clear()
+
+    def _check_agent(self, agent_reply):
         print(self.link.conn + ' agent_reply: ' + str(agent_reply))
         if agent_reply == '' or 'command not found' in agent_reply:
             agent_error = 'No \'wfx_test_agent\' on ' + self.link.conn + \
                           '. Communication OK, but we miss the agent!!\n reply: ' + str(agent_reply)
             raise Exception("%s: %s" % (self.nickname, agent_error))
 
-        for option in self.useful_options:
-            agent_result = self.run('wfx_test_agent ' + option)
-            print('wfx_test_agent ' + option + '  agent_result ' + agent_result)
-            if 'unknown' in self.run('wfx_test_agent ' + option):
-                agent_error = 'No \'' + option + '\' option in the ' + self.link.conn + \
-                              ' wfx_test_agent. We can talk to the agent,' + \
-                              ' but it does not reply to \'wfx_test_agent ' + option + '\'!!'
-                print("%s: MISSING USEFUL   OPTION: %s" % (self.nickname, agent_error))
-        if self.required_options:
-            print(str(len(self.required_options)) + ' required_options: ' + str(self.required_options))
-            for option in self.required_options:
-                agent_result = self.run('wfx_test_agent ' + option)
-                print('wfx_test_agent ' + option + '  agent_result ' + agent_result)
-                if 'unknown' in agent_result or agent_result == '':
-                    agent_error = 'No \'' + option + '\' option in the ' + self.link.conn + \
-                                  ' wfx_test_agent. We can talk to the agent,' + \
-                                  ' but it does not reply to \'wfx_test_agent ' + option + '\'!!'
-                    print("%s: MISSING CRITICAL OPTION: %s" % (self.nickname, agent_error))
-                    critical_message = critical_message + agent_error + '\n   '
-
-        if critical_message != '':
-            raise Exception("%s:\n   %s" % (self.nickname, critical_message))
+    def _check_option(self, option, agent_result, critical=False):
+        if 'unknown' in agent_result or (critical and agent_result == ''):
+            agent_error = 'No \'' + option + '\' option in the ' + self.link.conn + \
+                          ' wfx_test_agent. We can talk to the agent,' + \
+                          ' but it does not reply to \'wfx_test_agent ' + option + '\'!!'
+            if critical:
+                print("%s: MISSING CRITICAL OPTION: %s" % (self.nickname, agent_error))
+                return agent_error + '\n   '
+            print("%s: MISSING USEFUL   OPTION: %s" % (self.nickname, agent_error))
+        return ''
 
     @staticmethod
     def __errors_from_per(nb, per):
@@ -76,31 +85,31 @@ class WfxTestDut(WfxTestTarget):
         if ch is None:
             return self.wfx_get_list({'TEST_CHANNEL_FREQ'})
         else:
-            return self.wfx_set_dict({'TEST_CHANNEL_FREQ': ch}, send_data=0)
+            return self._set_dict({'TEST_CHANNEL_FREQ': ch}, send_data=0)
 
     def test_ind_period(self, period=None):
         if period is None:
             return self.wfx_get_list({'TEST_IND'})
         else:
-            return self.wfx_set_dict({'TEST_IND': period}, send_data=0)
+            return self._set_dict({'TEST_IND': period}, send_data=0)
 
     def tone_freq(self, offset=None):
         if offset is None:
             return self.wfx_get_list({"FREQ1"}, mode='quiet')
-        return self.wfx_set_dict({"FREQ1": offset}, send_data=1)
+        return self._set_dict({"FREQ1": offset}, send_data=1)
 
     def tone_power(self, dbm=None):
         if dbm is None:
             power = int(self.wfx_get_list({"MAX_OUTPUT_POWER"}, mode='quiet'))
             return "MAX_OUTPUT_POWER  " + str(power) + "  " + "     tone_power  " + str(power / 4.0) + " dBm"
         else:
-            return self.wfx_set_dict({"MAX_OUTPUT_POWER": int(4 * dbm)}, send_data=1)
+            return self._set_dict({"MAX_OUTPUT_POWER": int(4 * dbm)}, send_data=1)
 
     def tone_start(self, offset=None):
         if offset is None:
             offset = self.wfx_get_list({"FREQ1"}, mode='quiet')
         # CW Mode: generate CW @ offset*312.5Khz
-        return self.wfx_set_dict({"TEST_MODE": "tx_cw", "CW_MODE": "single", "FREQ1": offset}, send_data=1)
+        return self._set_dict({"TEST_MODE": "tx_cw", "CW_MODE": "single", "FREQ1": offset}, send_data=1)
 
     def tone_stop(self):
         return self.tx_stop()
@@ -111,9 +120,9 @@ class WfxTestDut(WfxTestTarget):
             return "MAX_OUTPUT_POWER_QDBM" + "  " + str(power) + \
                    "     tx_power  " + str(power / 4.0) + " dBm"
         else:
-            return self.wfx_set_dict({"MAX_OUTPUT_POWER_QDBM": int(4 * dbm),
-                                      "TEST_MODE": "tx_packet",
-                                      "NB_FRAME": 0}, send_data=1)
+            return self._set_dict({"MAX_OUTPUT_POWER_QDBM": int(4 * dbm),
+                                    "TEST_MODE": "tx_packet",
+                                    "NB_FRAME": 0}, send_data=1)
 
     def tx_backoff(self, mode_802_11=None, backoff_level=0):
         if backoff_level == "":
@@ -161,7 +170,7 @@ class WfxTestDut(WfxTestTarget):
                 return warning_msg
             value = [0, 0, 0, 0, 0, 0]
             value[index] = int(4 * backoff_level)
-            self.wfx_set_dict({"BACKOFF_VAL": str(value), "TEST_MODE": "tx_packet", "NB_FRAME": 0}, send_data=1)
+            self._set_dict({"BACKOFF_VAL": str(value), "TEST_MODE": "tx_packet", "NB_FRAME": 0}, send_data=1)
 
     def regulatory_mode(self, reg_mode=None):
         if reg_mode is None:
@@ -174,14 +183,14 @@ class WfxTestDut(WfxTestTarget):
                     reg_mode = old_namings[n]
             for m in possible_reg_modes:
                 if m in reg_mode:
-                    return self.wfx_set_dict({"REG_MODE": "CERTIFIED_" + m}, send_data=0)
+                    return self._set_dict({"REG_MODE": "CERTIFIED_" + m}, send_data=0)
             return "Unknown '" + reg_mode + " ' regulatory_mode. Use " + str(possible_reg_modes[0:5])
 
     def tx_framing(self, packet_length_bytes=None, ifs_us=100):
         if packet_length_bytes is None:
             return self.wfx_get_list({"FRAME_SIZE_BYTE", "IFS_US"})
         else:
-            return self.wfx_set_dict({"FRAME_SIZE_BYTE": packet_length_bytes, "IFS_US": ifs_us}, send_data=0)
+            return self._set_dict({"FRAME_SIZE_BYTE": packet_length_bytes, "IFS_US": ifs_us}, send_data=0)
 
     def tx_mode(self, mode_802_11=None):
         if mode_802_11 is None:
@@ -215,13 +224,13 @@ class WfxTestDut(WfxTestTarget):
                 warning_msg = "tx_mode: Unknown 802.11 mode " + str(mode_802_11)
                 add_pds_warning(warning_msg)
                 return warning_msg
-            return self.wfx_set_dict({"HT_PARAM": ht_param, "RATE": rate}, send_data=0)
+            return self._set_dict({"HT_PARAM": ht_param, "RATE": rate}, send_data=0)
 
     def tx_rx_select(self, tx_ant=None, rx_ant=None):
         if tx_ant is None:
             return self.wfx_get_list({"RF_PORTS"})
         else:
-            return self.wfx_set_dict({"RF_PORTS": "TX" + str(tx_ant) + "_RX" + str(rx_ant)})
+            return self._set_dict({"RF_PORTS": "TX" + str(tx_ant) + "_RX" + str(rx_ant)})
 
     def tx_start(self, nb_frames=None):
         if nb_frames is None:
@@ -229,14 +238,14 @@ class WfxTestDut(WfxTestTarget):
         else:
             if str(nb_frames) == "continuous":
                 nb_frames = 0
-            return self.wfx_set_dict({"TEST_MODE": "tx_packet", "NB_FRAME": nb_frames}, send_data=1)
+            return self._set_dict({"TEST_MODE": "tx_packet", "NB_FRAME": nb_frames}, send_data=1)
 
     def tx_stop(self):
-        res = self.wfx_set_dict({"TEST_MODE": "tx_packet", "NB_FRAME": 100}, send_data=1)
+        res = self._set_dict({"TEST_MODE": "tx_packet", "NB_FRAME": 100}, send_data=1)
         return res
 
     def rx_start(self):
-        res = self.wfx_set_dict({"TEST_MODE": "rx"}, send_data=1)
+        res = self._set_dict({"TEST_MODE": "rx"}, send_data=1)
         return res
 
     def rx_stop(self):
@@ -245,6 +254,8 @@ class WfxTestDut(WfxTestTarget):
         return self.tx_stop()
 
     def read_rx_stats(self):
+        if self.file_access:
+            return self.link.read_file(pds_env['RX_STATS_FILE']).strip()
         return self.run('wfx_test_agent read_rx_stats').strip()
 
     def rx_logs(self, mode=None):
@@ -261,7 +272,7 @@ class WfxTestDut(WfxTestTarget):
 
     def rx_receive(self, mode='global', frames=1000, timeout_s=0, sleep_ms=None):
         start = time.time()
-        self.__rx_clear()
+        self._rx_clear()
         nb_pkt = nb_same_timestamp = 0
         test_ind = int(self.test_ind_period().split()[1])
         if mode == 'endless':
@@ -289,32 +300,44 @@ class WfxTestDut(WfxTestTarget):
         while nb_pkt < frames:
             before = time.time()
             timestamp_changed = self.__rx_stats()
-            elapsed = int(time.time() - start)
-            if timestamp_changed != 0:
-                nb_same_timestamp = 0
-                print(str.format('%s >>> rx_receive:   mode %s %s   (%5.2f s)' %
-                                 (time_stamp(time.time()), mode, self.rx_logs(mode), elapsed)))
-                nb_pkt = self.rx_res[mode]['frames']
-            else:
-                nb_same_timestamp += 1
-                if nb_same_timestamp > 3:
-                    msg = ' Error: Rx stats timestamp not changing. Rx not running!'
-                    add_pds_warning(msg)
-                    print('\n', msg, '\n')
-                    break
-            if elapsed > timeout_s > 0:
-                msg = str.format(' Warning: Rx stats timeout after %5.2f seconds!' % elapsed)
-                add_pds_warning(msg)
-                print('\n', msg, '\n')
+            nb_pkt, nb_same_timestamp, stop = self._rx_progress(mode, timestamp_changed, start, timeout_s,
+                                                                nb_pkt, nb_same_timestamp)
+            if stop:
                 break
-            time_from_origin = before - origin
-            loops = int((time_from_origin*1000/sleep_ms) + 0.5)
-            next_loop = origin + ((loops+1)*sleep_ms/1000)
-            after = time.time()
-            sleep_this_time = int((next_loop - after)*1000)
-            time.sleep(sleep_this_time/1000)
+            time.sleep(self._rx_sleep_s(origin, before, sleep_ms))
         return self.rx_logs(mode)
 
+    def _rx_progress(self, mode, timestamp_changed, start, timeout_s, nb_pkt, nb_same_timestamp):
+        elapsed = int(time.time() - start)
+        if timestamp_changed != 0:
+            nb_same_timestamp = 0
+            print(str.format('%s >>> rx_receive:   mode %s %s   (%5.2f s)' %
+                             (time_stamp(time.time()), mode, self.rx_logs(mode), elapsed)))
+            nb_pkt = self.rx_res[mode]['frames']
+        else:
+            nb_same_timestamp += 1
+            if nb_same_timestamp > 3:
+                msg = ' Error: Rx stats timestamp not changing. Rx not running!'
+                add_pds_warning(msg)
+                print('\n', msg, '\n')
+                return nb_pkt, nb_same_timestamp, True
+        if elapsed > timeout_s > 0:
+            msg = str.format(' Warning: Rx stats timeout after %5.2f seconds!' % elapsed)
+            add_pds_warning(msg)
+            print('\n', msg, '\n')
+            return nb_pkt, nb_same_timestamp, True
+        return nb_pkt, nb_same_timestamp, False
+
+    @staticmethod
+    def _rx_sleep_s(origin, before, sleep_ms):
+        # Sleeping until the next loop, aligned on origin to avoid drifting
+        time_from_origin = before - origin
+        loops = int((time_from_origin*1000/sleep_ms) + 0.5)
+        next_loop = origin + ((loops+1)*sleep_ms/1000)
+        after = time.time()
+        sleep_this_time = int((next_loop - after)*1000)
+        return sleep_this_time/1000
+
     def read_agent_version(self):
         return self.run('wfx_test_agent read_agent_version').strip()
 
@@ -325,19 +348,22 @@ class WfxTestDut(WfxTestTarget):
         return self.run('wfx_test_agent read_fw_version').strip()
 
     def test_conditions(self):
-        agt = self.read_agent_version()
+        agt, fw, drv = [res.strip() for res, exit_status in self.run_many(['wfx_test_agent read_agent_version',
+                                                                            'wfx_test_agent read_fw_version',
+                                                                            'wfx_test_agent read_driver_version'])]
+        return self._test_conditions(agt, fw, drv)
+
+    def _test_conditions(self, agt, fw, drv):
         if 'ERROR' in agt or agt == '':
             agt = "unknown"
-        fw = self.read_fw_version()
         if 'ERROR' in fw or fw == '':
             fw = "unknown"
-        drv = self.read_driver_version()
         if 'ERROR' in drv or drv == '':
             drv = "unknown"
         return str.format("Test conditions: DUT %s / Driver %s / FW %s / Tools %s / Agent %s / %s" %
                           (self.nickname, drv, fw, WfxTestDut.tools_version, agt, self.link.conn))
 
-    def __rx_clear(self):
+    def _rx_clear(self):
         self.rx_res = {}
         self.rx_avg = {}
         self.rx_cnt = {}
@@ -360,10 +386,12 @@ class WfxTestDut(WfxTestTarget):
             self.rx_res[mode] = dict_items
 
     def __rx_stats(self):
+        return self._rx_parse(self.read_rx_stats())
+
+    def _rx_parse(self, lines):
         re_fr_per_th = re.compile('Num. of frames: (.*), PER \(x10e4\): (.*), Throughput: (.*)Kbps/s*')
         re_timestamp = re.compile('Timestamp: (.*)us')
         re_modulation = re.compile('\s*(\d+\w|\w+\d)\s*([-]*\d*)\s*([-]*\d*)\s*([-]*\d*)\s*([-]*\d*)\s*([-]*\d*)')
-        lines = self.read_rx_stats()
         return_val = 0
         for line in lines.split('\n'):
             stamp = re_timestamp.match(line)
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""wfx_test_dut_async.py
+    asyncio version of WfxTestDut, allowing a whole fleet of DUTs to be driven from a single thread
+
+    Use case:
+        duts = [AsyncWfxTestDut('Pi_%d' % n, host='10.5.124.%d' % n, user='root') for n in range(180, 190)]
+        await asyncio.gather(*(dut.connect() for dut in duts))
+        await asyncio.gather(*(dut.channel(7) for dut in duts))
+        await asyncio.gather(*(dut.tx_start('continuous') for dut in duts))
+
+    All DUT operations are coroutines. PDS tree handling is shared with WfxTestDut, only link accesses differ.
+"""
+
+import functools
+import collections
+
+from wfx_test_dut import *
+from wfx_connection_async import *
+
+
+def _awaitable(method):
+    # Wraps a WfxTestDut setter (or getter): the test data it queued (if any) is sent before returning
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        res = method(self, *args, **kwargs)
+        await self._send_queued_test_data()
+        return res
+    return wrapper
+
+
+class AsyncWfxTestDut(WfxTestDut):
+
+    def __init__(self, nickname, **kwargs):
+        # No I/O here: everything requiring the link is done in connect()
+        self._init_target(nickname)
+        self._init_dut()
+        self.fw_version = kwargs['fw_version'] if 'fw_version' in kwargs else None
+        self.skip_unchanged = kwargs['skip_unchanged'] if 'skip_unchanged' in kwargs else False
+        self.link = AsyncWfxConnection(nickname, **dict((k, v) for k, v in kwargs.items()
+                                                        if k not in ['fw_version', 'skip_unchanged']))
+        self.rx_task = None
+        # (compressed string, [(section, rendering)]) of the test data prepared by the setters, waiting to be sent
+        self.queued_test_data = collections.deque()
+
+    async def connect(self):
+        critical_message = ''
+        await self.link.connect()
+        if self.fw_version is not None:
+            self._fill_test_data(self.fw_version, forced=True)
+        else:
+            self._fill_test_data(await self.run('wfx_test_agent read_fw_version'))
+        self._check_agent(await self.run('wfx_test_agent read_agent_version'))
+        for option in self.useful_options:
+            agent_result = await self.run('wfx_test_agent ' + option)
+            print('wfx_test_agent ' + option + '  agent_result ' + agent_result)
+            self._check_option(option, agent_result)
+        for option in self.required_options:
+            agent_result = await self.run('wfx_test_agent ' + option)
+            print('wfx_test_agent ' + option + '  agent_result ' + agent_result)
+            critical_message += self._check_option(option, agent_result, critical=True)
+        if critical_message != '':
+            raise Exception("%s:\n   %s" % (self.nickname, critical_message))
+        return self
+
+    async def close(self):
+        await self.rx_kill()
+        await self.link.close()
+
+    async def write(self, text):
+        await self.link.write(text)
+
+    async def read(self):
+        return await self.link.read()
+
+    async def run(self, cmd, wait_ms=0):
+        return await self.link.run(cmd, wait_ms)
+
+    async def run_many(self, commands):
+        # One command after the other (no batching on asyncio links), exit statuses are not known
+        return [(await self.run(cmd), None) for cmd in commands]
+
+    def wait_for(self, pattern, timeout=10.0):
+        raise NotImplementedError("wait_for() is not available on asyncio links, use run()")
+
+    def run_until(self, cmd, pattern, timeout=10.0):
+        raise NotImplementedError("run_until() is not available on asyncio links, use run()")
+
+    def _prepare_and__send_test_data(self, parameters, send_data):
+        # Called by the (synchronous) WfxTestDut setters: the test data is queued, then sent by their wrapper
+        compressed_string = self._prepare_test_data(parameters, send_data)
+        if send_data:
+            self.queued_test_data.append((compressed_string, self.sending_test_data))
+
+    async def _send_queued_test_data(self):
+        while self.queued_test_data:
+            compressed_string, sending_test_data = self.queued_test_data.popleft()
+            await self._send_test_data(compressed_string, sending_test_data)
+
+    async def _send_test_data(self, compressed_string, sending_test_data):
+        if compressed_string is None:
+            return "test data unchanged, not sent"
+        cmd = self._test_data_command(compressed_string)
+        if cmd is None:
+            return "WARNING: No pds data sent! " + compressed_string
+        res = (await self.run(cmd)).strip()
+        self._test_data_sent(sending_test_data, compressed_string, res)
+        return res
+
+    async def wfx_set_dict(self, param_dict, send_data=1):
+        res = self._set_dict(param_dict, send_data)
+        await self._send_queued_test_data()
+        return res
+
+    async def read_rx_stats(self):
+        return (await self.run('wfx_test_agent read_rx_stats')).strip()
+
+    async def read_agent_version(self):
+        return (await self.run('wfx_test_agent read_agent_version')).strip()
+
+    async def read_driver_version(self):
+        return (await self.run('wfx_test_agent read_driver_version')).strip()
+
+    async def read_fw_version(self):
+        return (await self.run('wfx_test_agent read_fw_version')).strip()
+
+    async def test_conditions(self):
+        return self._test_conditions(await self.read_agent_version(), await self.read_fw_version(),
+                                     await self.read_driver_version())
+
+    async def _rx_endless(self, test_ind):
+        origin = time.time()
+        while True:
+            before = time.time()
+            self._rx_parse(await self.read_rx_stats())
+            await asyncio.sleep(max(0, self._rx_sleep_s(origin, before, test_ind)))
+
+    async def rx_kill(self):
+        if self.rx_task is not None:
+            self.rx_task.cancel()
+            try:
+                await self.rx_task
+            except asyncio.CancelledError:
+                pass
+        self.rx_task = None
+
+    async def rx_stop(self):
+        await self.rx_kill()
+        return await self.tx_stop()
+
+    async def tone_stop(self):
+        return await self.tx_stop()
+
+    async def rx_receive(self, mode='global', frames=1000, timeout_s=0, sleep_ms=None):
+        start = time.time()
+        self._rx_clear()
+        nb_pkt = nb_same_timestamp = 0
+        test_ind = int(self.wfx_get_list({'TEST_IND'}).split()[1])
+        if mode == 'endless':
+            await self.rx_stop()
+            await self.rx_start()
+            # Waiting for 110% of TEST_IND to read the first stats (see WfxTestDut.rx_receive)
+            await asyncio.sleep((test_ind * 1.1) / 1000)
+            self.rx_task = asyncio.ensure_future(self._rx_endless(test_ind))
+            return "Endless rx loop started with a period of " + str(test_ind) + " ms. Use " + \
+                   "'rx_logs()' to monitor Rx, " + \
+                   "'rx_kill()' to stop Rx monitoring, " + \
+                   "'rx_stop()' to stop Rx entirely"
+        mode = 'global' if mode not in self.rx_modulations else mode
+        await asyncio.sleep((test_ind * 1.1) / 1000)
+        origin = time.time()
+        if sleep_ms is None:
+            sleep_ms = test_ind
+        while nb_pkt < frames:
+            before = time.time()
+            timestamp_changed = self._rx_parse(await self.read_rx_stats())
+            nb_pkt, nb_same_timestamp, stop = self._rx_progress(mode, timestamp_changed, start, timeout_s,
+                                                                nb_pkt, nb_same_timestamp)
+            if stop:
+                break
+            await asyncio.sleep(max(0, self._rx_sleep_s(origin, before, sleep_ms)))
+        return self.rx_logs(mode)
+
+    # Setters (and getters, for consistency) are shared with WfxTestDut, their test data being sent by _awaitable
+    channel = _awaitable(WfxTestDut.channel)
+    test_ind_period = _awaitable(WfxTestDut.test_ind_period)
+    tone_freq = _awaitable(WfxTestDut.tone_freq)
+    tone_power = _awaitable(WfxTestDut.tone_power)
+    tone_start = _awaitable(WfxTestDut.tone_start)
+    tx_power = _awaitable(WfxTestDut.tx_power)
+    tx_backoff = _awaitable(WfxTestDut.tx_backoff)
+    regulatory_mode = _awaitable(WfxTestDut.regulatory_mode)
+    tx_framing = _awaitable(WfxTestDut.tx_framing)
+    tx_mode = _awaitable(WfxTestDut.tx_mode)
+    tx_rx_select = _awaitable(WfxTestDut.tx_rx_select)
+    tx_start = _awaitable(WfxTestDut.tx_start)
+    tx_stop = _awaitable(WfxTestDut.tx_stop)
+    rx_start = _awaitable(WfxTestDut.rx_start)
+
+
+if __name__ == '__main__':
+
+    async def main():
+        hosts = ['10.5.124.186', '10.5.124.187']
+        duts = [AsyncWfxTestDut('Pi_' + host.split('.')[-1], host=host, user='root') for host in hosts]
+        await asyncio.gather(*(dut.connect() for dut in duts))
+        print('\n'.join(await asyncio.gather(*(dut.test_conditions() for dut in duts))))
+        await asyncio.gather(*(dut.channel(7) for dut in duts))
+        await asyncio.gather(*(dut.tx_power(11.25) for dut in duts))
+        await asyncio.gather(*(dut.tx_start('continuous') for dut in duts))
+        await asyncio.sleep(1)
+        await asyncio.gather(*(dut.tx_stop() for dut in duts))
+        await asyncio.gather(*(dut.close() for dut in duts))
+
+    asyncio.run(main())
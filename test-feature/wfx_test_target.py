@@ -16,6 +16,7 @@ pds_env['TEST_FEATURE_ROOT'] = "/home/pi/siliconlabs/wfx-linux-tools/test-featur
 pds_env['PDS_ROOT'] = pds_env['TEST_FEATURE_ROOT'] + "PDS/"
 pds_env['PDS_CURRENT_FILE'] = "/tmp/current_pds_data.in"
 pds_env['SEND_PDS_FILE'] = "/sys/kernel/debug/ieee80211/phy0/wfx/send_pds"
+pds_env['RX_STATS_FILE'] = "/sys/kernel/debug/ieee80211/phy0/wfx/rx_stats"
 pds_env['PDS_DEFINITION_ROOT'] = ""
 pds_env['PDS_DEFINITION_FILE'] = "definitions.in"
 pds_env['required_options'] = []
@@ -26,46 +27,75 @@ class WfxTestTarget(object):
     global pds_env
 
     def __init__(self, nickname, **kwargs):
-        self.trace = False
-        self.human_trace = False
-        self.compressed_trace = False
-        self.nickname = nickname
-        self.test_data = PdsTree()
-        self.link = None
-        self.required_options = pds_env['required_options']
-        self.useful_options = pds_env['useful_options']
-        if 'host' in kwargs:
+        self._init_target(nickname)
+        # skip_unchanged: sections already sent with the same values are not sent again (test_data.unsent())
+        self.skip_unchanged = kwargs['skip_unchanged'] if 'skip_unchanged' in kwargs else False
+        if 'link' in kwargs:
+            # Any link object (such as a wfx_replay Recorder or Replay), used as is
+            self.link = kwargs['link']
+        if not self.link and 'host' in kwargs:
             host = kwargs['host']
             port = kwargs['port'] if 'port' in kwargs else 22
             user = kwargs['user'] if 'user' in kwargs else 'root'
             print('%s: Configuring a SSH connection to host %s for user %s' % (nickname, host, user))
             password = kwargs['password'] if 'password' in kwargs else None
-            self.link = Ssh(nickname, host=host, user=user, port=port, password=password)
+            persistent = kwargs['persistent'] if 'persistent' in kwargs else False
+            self.link = Ssh(nickname, host=host, user=user, port=port, password=password, persistent=persistent)
+            # sftp: send_pds and rx_stats are accessed as files over SFTP, instead of through wfx_test_agent
+            self.file_access = kwargs['sftp'] if 'sftp' in kwargs else False
 
         if not self.link:
             if 'port' in kwargs:
                 port = kwargs['port']
                 print('%s: Configuring a UART connection using %s' % (nickname, port))
-                self.link = Uart(nickname, port=port)
+                framed = kwargs['framed'] if 'framed' in kwargs else None
+                reader = kwargs['reader'] if 'reader' in kwargs else False
+                fast_baudrate = kwargs['fast_baudrate'] if 'fast_baudrate' in kwargs else None
+                binary = kwargs['binary'] if 'binary' in kwargs else False
+                self.link = Uart(nickname, port=port, framed=framed, reader=reader, fast_baudrate=fast_baudrate,
+                                 binary=binary)
                 if self.link is None:
                     if port in uarts():
                         raise Exception(port + ' is detected but is not available. Check for other applications using ' + port)
 
         if not self.link:
-            if not kwargs:
+            if not [key for key in kwargs if key not in ['persistent', 'sftp', 'native', 'skip_unchanged']]:
                 print('%s: Configuring a Direct connection' % nickname)
-                self.link = Direct(nickname)
+                persistent = kwargs['persistent'] if 'persistent' in kwargs else False
+                # native: debugfs accesses are done in-process (see Native)
+                native = kwargs['native'] if 'native' in kwargs else False
+                if native:
+                    self.link = Native(nickname, persistent=persistent)
+                else:
+                    self.link = Direct(nickname, persistent=persistent)
 
         if 'fw_version' in kwargs:
-            fw_version = kwargs['fw_version']
+            self._fill_test_data(kwargs['fw_version'], forced=True)
+        else:
+            self._fill_test_data(self.run('wfx_test_agent read_fw_version'))
+
+    def _init_target(self, nickname):
+        self.trace = False
+        self.human_trace = False
+        self.compressed_trace = False
+        self.nickname = nickname
+        self.test_data = PdsTree()
+        self.link = None
+        self.file_access = False
+        self.skip_unchanged = False
+        # [(section, rendering)] of the test data being sent
+        self.sending_test_data = None
+        self.required_options = pds_env['required_options']
+        self.useful_options = pds_env['useful_options']
+
+    def _fill_test_data(self, fw_version, forced=False):
+        if forced:
             print("%s: fw_version forced (%s)" % (self.nickname, fw_version))
+        elif not re.match("\d+\.\d+\.\d+", fw_version):
+            fw_version = self.test_data.max_fw_version
+            print("%s: No fw_version retrieved from HW, using max_fw_version (%s)" % (self.nickname, fw_version))
         else:
-            fw_version = self.run('wfx_test_agent read_fw_version')
-            if not re.match("\d+\.\d+\.\d+", fw_version):
-                fw_version = self.test_data.max_fw_version
-                print("%s: No fw_version retrieved from HW, using max_fw_version (%s)" % (self.nickname, fw_version))
-            else:
-                print("%s: fw_version retrieved from HW (%s)" % (self.nickname, fw_version))
+            print("%s: fw_version retrieved from HW (%s)" % (self.nickname, fw_version))
         self.test_data.fill_tree(fw_version)
         print('%s: tree filled for FW%s' % (self.nickname, fw_version))
 
@@ -84,9 +114,39 @@ class WfxTestTarget(object):
         time.sleep(wait_ms/1000.0)
         return self.read()
 
-    def _prepare_test_data(self, parameters):
+    @property
+    def latency(self):
+        # Per command verb latency histograms of the link (see wfx_latency.py)
+        return self.link.latency if self.link is not None else None
+
+    def wait_for(self, pattern, timeout=10.0):
+        # Returns the output as soon as it matches pattern (regex or predicate), raises LinkTimeout otherwise
+        if self.link is None:
+            raise LinkTimeout(self.nickname, pattern, 0, '')
+        return self.link.wait_for(pattern, timeout)
+
+    def run_until(self, cmd, pattern, timeout=10.0):
+        self.write(cmd)
+        return self.wait_for(pattern, timeout)
+
+    def run_many(self, commands):
+        # Sends all commands in a single round trip (when the link allows it), returns (result, exit_status) tuples
+        if self.link is not None:
+            return self.link.run_many(commands)
+        else:
+            return [('', None) for cmd in commands]
+
+    def _prepare_test_data(self, parameters, send_data=0):
+        # None when all sections have already been sent with the same values (skip_unchanged)
         _subtree = self.test_data.sub_tree(parameters)
-        pds_sections = _subtree.pretty()
+        if send_data and self.skip_unchanged:
+            _subtree = self.test_data.unsent(_subtree)
+            if _subtree is None:
+                if self.trace:
+                    print(str.format("%-8s SET|  " % self.nickname), "test data unchanged, not sent")
+                return None
+        self.sending_test_data = _subtree.sections()
+        pds_sections = ''.join(text for section, text in self.sending_test_data)
 
         pds_string = "#include \"" + pds_env['PDS_DEFINITION_ROOT'] + pds_env['PDS_DEFINITION_FILE']\
                      + "\"\n\n" + pds_compatibility_text + pds_sections
@@ -102,22 +162,45 @@ class WfxTestTarget(object):
 
         return compressed_string
 
-    def _send_test_data(self, compressed_string):
-        res = ''
+    @staticmethod
+    def _test_data_command(compressed_string):
         if ":error:" in compressed_string:
-            res += "WARNING: No pds data sent! " + compressed_string + "\n"
             add_pds_warning("WARNING: No pds data sent! " + compressed_string + "\n")
-        else:
-            cmd = 'wfx_test_agent write_test_data  \"' + compressed_string + '\"'
-            res = self.run(cmd)
-        return res.strip()
+            return None
+        return 'wfx_test_agent write_test_data  \"' + compressed_string + '\"'
+
+    def _test_data_sent(self, sections, compressed_string, res):
+        # Records sections as sent if the agent wrote them ("'...' sent to <send_pds>", exit status 0 if known)
+        if ' sent to ' not in res or getattr(self.link, 'exit_status', None) not in [None, 0]:
+            err = "WARNING: test data not written! " + res + "\n"
+            print(err)
+            add_pds_warning(err)
+            return
+        self.test_data.mark_sent(sections, len(compressed_string))
+
+    def _send_test_data(self, compressed_string):
+        if compressed_string is None:
+            return "test data unchanged, not sent"
+        cmd = self._test_data_command(compressed_string)
+        if cmd is None:
+            return "WARNING: No pds data sent! " + compressed_string
+        if self.file_access:
+            # Same data as 'wfx_test_agent write_test_data', without running it (write errors are raised)
+            written = self.link.write_file(pds_env['SEND_PDS_FILE'], compressed_string + '\n')
+            if not written:
+                return "WARNING: No pds data sent! No link to write " + pds_env['SEND_PDS_FILE']
+            self.test_data.mark_sent(self.sending_test_data, len(compressed_string))
+            return "%d bytes written to %s" % (written, pds_env['SEND_PDS_FILE'])
+        res = self.run(cmd).strip()
+        self._test_data_sent(self.sending_test_data, compressed_string, res)
+        return res
 
     def _prepare_and__send_test_data(self, parameters, send_data):
-        compressed_string = self._prepare_test_data(parameters)
+        compressed_string = self._prepare_test_data(parameters, send_data)
         if send_data:
             self._send_test_data(compressed_string)
 
-    def wfx_set_dict(self, param_dict, send_data=1):
+    def _set_parameters(self, param_dict):
         res = ''
         parameters = []
         for p, v in param_dict.items():
@@ -128,8 +211,16 @@ class WfxTestTarget(object):
             parameters.append(parameter)
         if self.trace:
             print(str.format("%-8s SET|  " % self.nickname), res.strip())
+        return res.strip(), parameters
+
+    def _set_dict(self, param_dict, send_data=1):
+        # Used by the setters: AsyncWfxTestDut queues the test data (in _prepare_and__send_test_data()) instead
+        res, parameters = self._set_parameters(param_dict)
         self._prepare_and__send_test_data(parameters, send_data)
-        return res.strip()
+        return res
+
+    def wfx_set_dict(self, param_dict, send_data=1):
+        return self._set_dict(param_dict, send_data)
 
     def wfx_get_list(self, param_list, mode='verbose'):
         res = ''